@@ -6,13 +6,22 @@ import os
 
 import uvicorn
 
-from app_factory import create_app
-
-app = create_app()
-
 
 if __name__ == "__main__":
     host = os.getenv("APP_HOST", "127.0.0.1")
     port = int(os.getenv("APP_PORT", "5001"))
     reload = os.getenv("APP_ENV", "development").lower() == "development"
-    uvicorn.run("app:app", host=host, port=port, reload=reload)
+    # uvloop is unavailable on Windows and unreliable under the reloader.
+    fast_loop = not reload and os.name != "nt"
+    # The factory keeps this module import-free of side effects, so spawned children
+    # (e.g. the background removal pool) do not build a second app when they re-import it.
+    uvicorn.run(
+        "app_factory:create_app",
+        factory=True,
+        host=host,
+        port=port,
+        reload=reload,
+        loop="uvloop" if fast_loop else "auto",
+        http="httptools" if fast_loop else "auto",
+        workers=None if reload else int(os.getenv("UVICORN_WORKERS", "1")),
+    )
@@ -2,64 +2,67 @@
 
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
 
+import orjson
 from dotenv import load_dotenv
 from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
 from starlette.middleware.sessions import SessionMiddleware
 
 if os.getenv("LOAD_DOTENV", "1").lower() == "1":
     load_dotenv(os.getenv("DOTENV_FILE") or None)
 
-try:
-    from config import BaseConfig, get_config_class
-    from logging_config import configure_logging
-    from paths import RESULT_DIR, UPLOAD_DIR, ensure_directories
-    from routes import register_routes
-    from services import AppServices
-    from services.ai import build_image_editor
-    from services.background_removal import BackgroundRemovalService
-    from services.history import GenerationHistoryStore
-    from services.image_pipeline import ImagePipeline
-    from services.image_assets import ImageAssetStore
-    from services.cleanup import cleanup_folder
-    from services.styles_postgres import PostgresStyleCatalog
-except ImportError:  # pragma: no cover
-    from .config import BaseConfig, get_config_class
+if __package__:
+    from .config import BaseConfig, config_snapshot, get_config_class
     from .logging_config import configure_logging
-    from .paths import RESULT_DIR, UPLOAD_DIR, ensure_directories
+    from .paths import RESULT_DIR, TEMPLATE_CACHE_DIR, UPLOAD_DIR, ensure_directories
     from .routes import register_routes
+    from .routes.static import CachedStaticFiles
+    from .session_middleware import RedisSessionMiddleware, SessionExemptPathsMiddleware
     from .services import AppServices
-    from .services.ai import build_image_editor
-    from .services.background_removal import BackgroundRemovalService
+    from .services.ai import LazyImageEditor, describe_editor
+    from .services.background_removal import build_background_removal, create_removal_executor
     from .services.history import GenerationHistoryStore
     from .services.image_pipeline import ImagePipeline
     from .services.image_assets import ImageAssetStore
     from .services.cleanup import cleanup_folder
+    from .services.db import create_pool
     from .services.styles_postgres import PostgresStyleCatalog
+else:
+    from config import BaseConfig, config_snapshot, get_config_class
+    from logging_config import configure_logging
+    from paths import RESULT_DIR, TEMPLATE_CACHE_DIR, UPLOAD_DIR, ensure_directories
+    from routes import register_routes
+    from routes.static import CachedStaticFiles
+    from session_middleware import RedisSessionMiddleware, SessionExemptPathsMiddleware
+    from services import AppServices
+    from services.ai import LazyImageEditor, describe_editor
+    from services.background_removal import build_background_removal, create_removal_executor
+    from services.history import GenerationHistoryStore
+    from services.image_pipeline import ImagePipeline
+    from services.image_assets import ImageAssetStore
+    from services.cleanup import cleanup_folder
+    from services.db import create_pool
+    from services.styles_postgres import PostgresStyleCatalog
 
 
-def _resolve_ai_metadata(config: dict) -> tuple[str, str]:
-    provider = str(config.get("IMAGE_PROVIDER", "nano_banana")).lower()
-    if provider == "nano_banana":
-        model_name = str(config.get("GEMINI_MODEL", "gemini-3-pro-image-preview"))
-        if str(config.get("FAST_MODE", "false")).lower() == "true":
-            model_name = str(config.get("GEMINI_MODEL_FAST", "gemini-2.5-flash-image"))
-        label_map = {
-            "gemini-3-pro-image-preview": "Gemini 3 Pro Image Preview",
-            "gemini-2.5-flash-image": "Gemini 2.5 Flash Image",
-        }
-        model_label = label_map.get(model_name, model_name)
-        return f"Nano Banana ({model_label})", "nano"
-    return "AI", "ai"
+def _resolve_ai_metadata(
+    provider: str, model: str, model_fast: str, fast_mode: bool
+) -> tuple[str, str]:
+    return describe_editor(provider, model_fast if fast_mode else model)
 
 
 logger = logging.getLogger(__name__)
 
 
+_BODYLESS_METHODS = frozenset({"GET", "HEAD", "DELETE", "OPTIONS"})
+_HTTP_REQUEST = "http.request"
+
+
 class MaxBodySizeExceeded(Exception):
     pass
 
@@ -74,8 +77,16 @@ class MaxBodySizeMiddleware:
             await self.app(scope, receive, send)
             return
 
-        headers = {key.lower(): value for key, value in scope.get("headers", [])}
-        content_length = headers.get(b"content-length")
+        if scope.get("method") in _BODYLESS_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = None
+        # ASGI header names are already lowercased bytes.
+        for key, value in scope.get("headers", ()):
+            if key == b"content-length":
+                content_length = value
+                break
         if content_length is not None:
             try:
                 declared_length = int(content_length)
@@ -84,17 +95,21 @@ class MaxBodySizeMiddleware:
             if declared_length > self.max_body_size:
                 await _send_too_large(send)
                 return
+            if declared_length > 0:
+                # The server enforces Content-Length framing, so no counting is needed.
+                await self.app(scope, receive, send)
+                return
 
         received = 0
         response_started = False
+        limit = self.max_body_size
 
         async def receive_wrapper():
             nonlocal received
             message = await receive()
-            if message["type"] == "http.request":
-                body = message.get("body", b"")
-                received += len(body)
-                if received > self.max_body_size:
+            if message["type"] == _HTTP_REQUEST and "body" in message:
+                received += len(message["body"])
+                if received > limit:
                     raise MaxBodySizeExceeded()
             return message
 
@@ -112,19 +127,33 @@ class MaxBodySizeMiddleware:
             await _send_too_large(send)
 
 
+_TOO_LARGE_PAYLOAD = orjson.dumps({"error": "Request body too large."})
+_TOO_LARGE_START = {
+    "type": "http.response.start",
+    "status": 413,
+    "headers": (
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(_TOO_LARGE_PAYLOAD)).encode("ascii")),
+    ),
+}
+_TOO_LARGE_BODY = {"type": "http.response.body", "body": _TOO_LARGE_PAYLOAD}
+
+
 async def _send_too_large(send) -> None:
-    payload = b'{"error":"Request body too large."}'
-    await send(
-        {
-            "type": "http.response.start",
-            "status": 413,
-            "headers": [
-                (b"content-type", b"application/json"),
-                (b"content-length", str(len(payload)).encode("ascii")),
-            ],
-        }
+    # Outer middleware may rebind message["headers"], so hand each send a shallow copy.
+    await send(dict(_TOO_LARGE_START))
+    await send(dict(_TOO_LARGE_BODY))
+
+
+def _build_template_env(app_config: type[BaseConfig]) -> Environment:
+    # Compiled templates are cached on disk; production skips the per-render mtime check.
+    return Environment(
+        loader=FileSystemLoader("templates"),
+        autoescape=select_autoescape(),
+        bytecode_cache=FileSystemBytecodeCache(directory=str(TEMPLATE_CACHE_DIR)),
+        auto_reload=getattr(app_config, "ENV", "development") != "production",
+        cache_size=400,
     )
-    await send({"type": "http.response.body", "body": payload})
 
 
 def create_app(config_class: type[BaseConfig] | None = None) -> FastAPI:
@@ -134,80 +163,93 @@ def create_app(config_class: type[BaseConfig] | None = None) -> FastAPI:
     configure_logging(getattr(app_config, "LOG_LEVEL", "INFO"))
     ensure_directories()
     max_body_size = int(getattr(app_config, "MAX_CONTENT_LENGTH", 0) or 0)
-    if max_body_size > 0:
-        # Enforce request size limits early to protect the server.
+    trust_proxy_limit = bool(getattr(app_config, "TRUST_PROXY_BODY_LIMIT", False))
+    if max_body_size > 0 and not trust_proxy_limit:
+        # Enforce request size limits early unless the reverse proxy already does.
         app.add_middleware(MaxBodySizeMiddleware, max_body_size=max_body_size)
 
     db_url = getattr(app_config, "DATABASE_URL", "").strip()
     if not db_url:
         raise RuntimeError("DATABASE_URL is required for image storage.")
-    image_store = ImageAssetStore(db_url, getattr(app_config, "ALLOWED_EXTENSIONS", []))
-    history_store = GenerationHistoryStore(db_url)
-    auto_migrate = bool(getattr(app_config, "AUTO_MIGRATE", False))
-    if auto_migrate:
-        try:
-            image_store.ensure_schema()
-        except Exception as exc:
-            logger.error("Failed to initialize image storage: %s", exc)
-            raise
-        try:
-            history_store.ensure_schema()
-        except Exception as exc:
-            logger.error("Failed to initialize history storage: %s", exc)
-            raise
-
-    config_values = {key: getattr(app_config, key) for key in dir(app_config) if key.isupper()}
-    ai_label, ai_suffix = _resolve_ai_metadata(config_values)
-    editor = build_image_editor(config_values)
+    db_pool = create_pool(
+        db_url,
+        min_size=getattr(app_config, "DB_POOL_MIN_SIZE", 2),
+        max_size=getattr(app_config, "DB_POOL_MAX_SIZE", 20),
+    )
+    image_store = ImageAssetStore(db_pool, getattr(app_config, "ALLOWED_EXTENSIONS", []))
+    history_store = GenerationHistoryStore(db_pool)
+    config_values = config_snapshot(app_config)
+    ai_label, ai_suffix = _resolve_ai_metadata(
+        str(getattr(app_config, "IMAGE_PROVIDER", "nano_banana")),
+        str(getattr(app_config, "GEMINI_MODEL", "gemini-3-pro-image-preview")),
+        str(getattr(app_config, "GEMINI_MODEL_FAST", "gemini-2.5-flash-image")),
+        str(getattr(app_config, "FAST_MODE", False)).lower() == "true",
+    )
+    # Provider clients and rembg models are built on first use to keep startup fast.
+    editor = LazyImageEditor(config_values)
 
     pipeline = ImagePipeline(
-        result_dir=RESULT_DIR,
         editor=editor,
         ai_label=ai_label,
         ai_suffix=ai_suffix,
+        png_compress_level=int(getattr(app_config, "PIPELINE_PNG_COMPRESS_LEVEL", 1)),
     )
     fast_mode = bool(getattr(app_config, "FAST_MODE", False))
-    background_model = getattr(app_config, "BACKGROUND_REMOVAL_MODEL", "u2net")
-    alpha_matting = getattr(app_config, "BACKGROUND_REMOVAL_ALPHA_MATTING", True)
-    post_process = getattr(app_config, "BACKGROUND_REMOVAL_POST_PROCESS", True)
-    if fast_mode:
-        background_model = getattr(
-            app_config, "BACKGROUND_REMOVAL_MODEL_FAST", "birefnet-general-lite"
-        )
-        alpha_matting = getattr(app_config, "BACKGROUND_REMOVAL_FAST_ALPHA_MATTING", False)
-        post_process = getattr(app_config, "BACKGROUND_REMOVAL_FAST_POST_PROCESS", False)
-    background_removal = BackgroundRemovalService(
-        RESULT_DIR,
-        model_name=background_model,
-        alpha_matting=alpha_matting,
-        alpha_matting_foreground_threshold=getattr(
-            app_config, "BACKGROUND_REMOVAL_FG_THRESHOLD", 240
-        ),
-        alpha_matting_background_threshold=getattr(
-            app_config, "BACKGROUND_REMOVAL_BG_THRESHOLD", 10
-        ),
-        alpha_matting_erode_size=getattr(app_config, "BACKGROUND_REMOVAL_ERODE_SIZE", 10),
-        post_process_mask=post_process,
-        lazy_init=bool(getattr(app_config, "BACKGROUND_REMOVAL_LAZY_INIT", False)),
+    # The web process only removes backgrounds inline when async jobs are disabled,
+    # and then in worker processes unless the pool is turned off.
+    removal_processes = 0
+    if not bool(getattr(app_config, "ASYNC_TASKS_ENABLED", True)):
+        removal_processes = int(getattr(app_config, "BACKGROUND_REMOVAL_PROCESSES", 0) or 0)
+    lazy_removal = (
+        bool(getattr(app_config, "ASYNC_TASKS_ENABLED", True)) or removal_processes > 0
+    )
+    background_removal = build_background_removal(
+        config_values, RESULT_DIR, fast_mode, lazy_init=lazy_removal
+    )
+    background_removal_alt = build_background_removal(
+        config_values, RESULT_DIR, not fast_mode, lazy_init=True
     )
-    styles = PostgresStyleCatalog(db_url, getattr(app_config, "STYLE_RULES_MAX_CHARS", 4000))
+    styles = PostgresStyleCatalog(db_pool, getattr(app_config, "STYLE_RULES_MAX_CHARS", 4000))
     app.state.services = AppServices(
         assets=image_store,
         pipeline=pipeline,
         background_removal=background_removal,
+        background_removal_alt=background_removal_alt,
         styles=styles,
         history=history_store,
     )
 
+    app.state.bg_pool = None
+    if removal_processes > 0:
+        app.state.bg_pool = create_removal_executor(
+            config_values, RESULT_DIR, fast_mode, removal_processes
+        )
     app.state.config = app_config
-    app.state.templates = Jinja2Templates(directory="templates")
-    app.mount("/static", StaticFiles(directory="static"), name="static")
-    app.add_middleware(
-        SessionMiddleware,
-        secret_key=getattr(app_config, "SECRET_KEY", "dev-secret-2025"),
-        same_site=getattr(app_config, "SESSION_COOKIE_SAMESITE", "Lax"),
-        https_only=getattr(app_config, "SESSION_COOKIE_SECURE", False),
+    app.state.config_values = config_values
+    app.state.templates = Jinja2Templates(env=_build_template_env(app_config))
+    # Development edits CSS/JS under a running server, so files are served from disk there.
+    static_files = CachedStaticFiles(
+        directory="static",
+        cache_in_memory=getattr(app_config, "ENV", "development") == "production",
     )
+    app.mount("/static", static_files, name="static")
+    if getattr(app_config, "SESSION_BACKEND", "cookie") == "redis":
+        app.add_middleware(
+            SessionExemptPathsMiddleware,
+            session_middleware=RedisSessionMiddleware,
+            redis_url=getattr(app_config, "SESSION_REDIS_URL", ""),
+            same_site=getattr(app_config, "SESSION_COOKIE_SAMESITE", "Lax"),
+            https_only=getattr(app_config, "SESSION_COOKIE_SECURE", False),
+        )
+    else:
+        # Signed cookies keep local mode working without Redis.
+        app.add_middleware(
+            SessionExemptPathsMiddleware,
+            session_middleware=SessionMiddleware,
+            secret_key=getattr(app_config, "SECRET_KEY", "dev-secret-2025"),
+            same_site=getattr(app_config, "SESSION_COOKIE_SAMESITE", "Lax"),
+            https_only=getattr(app_config, "SESSION_COOKIE_SECURE", False),
+        )
 
     register_routes(app)
 
@@ -216,10 +258,35 @@ def create_app(config_class: type[BaseConfig] | None = None) -> FastAPI:
         cleanup_folder(UPLOAD_DIR, getattr(app_config, "CLEANUP_MAX_AGE_MINUTES", 0))
         cleanup_folder(RESULT_DIR, getattr(app_config, "CLEANUP_MAX_AGE_MINUTES", 0))
 
-    if (
-        getattr(app_config, "ENV", "development") == "production"
-        and getattr(app_config, "SECRET_KEY", "dev-secret-2025") == "dev-secret-2025"
-    ):
-        logger.warning("Using default SECRET_KEY in production.")
+    auto_migrate = bool(getattr(app_config, "AUTO_MIGRATE", False))
+
+    async def _on_startup() -> None:
+        # Compile the page template up front so the first request does not pay for it.
+        app.state.templates.env.get_template("index.html")
+        # Schema DDL runs once the server starts instead of on every create_app call.
+        if auto_migrate:
+            try:
+                await asyncio.to_thread(image_store.ensure_schema)
+            except Exception as exc:
+                logger.error("Failed to initialize image storage: %s", exc)
+                raise
+            try:
+                await asyncio.to_thread(history_store.ensure_schema)
+            except Exception as exc:
+                logger.error("Failed to initialize history storage: %s", exc)
+                raise
+        if (
+            getattr(app_config, "ENV", "development") == "production"
+            and getattr(app_config, "SECRET_KEY", "dev-secret-2025") == "dev-secret-2025"
+        ):
+            logger.warning("Using default SECRET_KEY in production.")
+
+    async def _on_shutdown() -> None:
+        if app.state.bg_pool is not None:
+            app.state.bg_pool.shutdown(wait=False, cancel_futures=True)
+        await asyncio.to_thread(db_pool.close)
+
+    app.add_event_handler("startup", _on_startup)
+    app.add_event_handler("shutdown", _on_shutdown)
 
     return app
@@ -26,6 +26,9 @@ def _default_worker_pool() -> str:
     return "solo" if os.name == "nt" else "prefork"
 
 
+GREEN_POOLS = {"gevent", "eventlet"}
+
+
 DEFAULT_QUEUE = os.getenv("CELERY_QUEUE_GENERATION", "ivg_generate")
 BG_QUEUE = os.getenv("CELERY_QUEUE_BG_REMOVE", "ivg_bg")
 
@@ -43,11 +46,18 @@ def create_celery_app() -> Celery:
     autoscale_min = _int_env("CELERY_WORKER_AUTOSCALE_MIN", "0")
     autoscale_max = _int_env("CELERY_WORKER_AUTOSCALE_MAX", "0")
     worker_pool = os.getenv("CELERY_WORKER_POOL", _default_worker_pool())
+    # Task args and results are flat str/bool maps; msgpack encodes them smaller and faster.
+    serializer = os.getenv("CELERY_SERIALIZER", "msgpack").lower()
+    # Green pools multiplex I/O-bound Gemini calls, so they default to high concurrency.
+    worker_concurrency = _int_env(
+        "CELERY_WORKER_CONCURRENCY", "100" if worker_pool in GREEN_POOLS else "0"
+    )
     app.conf.update(
         task_track_started=True,
-        task_serializer="json",
-        result_serializer="json",
-        accept_content=["json"],
+        task_serializer=serializer,
+        result_serializer=serializer,
+        # JSON stays accepted so messages queued before a serializer switch still run.
+        accept_content=["json", "msgpack"],
         broker_connection_retry_on_startup=True,
         task_always_eager=_bool_env("CELERY_TASK_ALWAYS_EAGER", "false") or not async_enabled,
         task_eager_propagates=True,
@@ -58,7 +68,16 @@ def create_celery_app() -> Celery:
         },
         result_expires=_int_env("CELERY_RESULT_EXPIRES", "86400"),
         worker_pool=worker_pool,
+        # Children warm pools, clients, and models in worker_process_init before taking jobs.
+        worker_proc_alive_timeout=_int_env("CELERY_WORKER_PROC_ALIVE_TIMEOUT", "60"),
+        # Broker and result-backend sockets are reused per process rather than reopened.
+        broker_pool_limit=_int_env("CELERY_BROKER_POOL_LIMIT", "10"),
     )
+    if worker_concurrency > 0:
+        app.conf.worker_concurrency = worker_concurrency
+    redis_max_connections = _int_env("CELERY_REDIS_MAX_CONNECTIONS", "0")
+    if redis_max_connections > 0:
+        app.conf.redis_max_connections = redis_max_connections
     if autoscale_min > 0 and autoscale_max >= autoscale_min:
         app.conf.worker_autoscale = (autoscale_max, autoscale_min)
     return app
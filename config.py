@@ -3,6 +3,9 @@
 from __future__ import annotations
 
 import os
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Mapping
 
 
 class BaseConfig:
@@ -11,6 +14,7 @@ class BaseConfig:
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
     MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH_MB", "10")) * 1024 * 1024
+    TRUST_PROXY_BODY_LIMIT = os.getenv("TRUST_PROXY_BODY_LIMIT", "false").lower() == "true"
     AUTO_MIGRATE = (
         os.getenv("AUTO_MIGRATE", "false" if ENV == "production" else "true").lower()
         == "true"
@@ -26,6 +30,7 @@ class BaseConfig:
     GEMINI_BACKOFF_MAX_SECONDS = float(os.getenv("GEMINI_BACKOFF_MAX_SECONDS", "8"))
     GEMINI_CB_THRESHOLD = int(os.getenv("GEMINI_CB_THRESHOLD", "5"))
     GEMINI_CB_COOLDOWN_SECONDS = float(os.getenv("GEMINI_CB_COOLDOWN_SECONDS", "60"))
+    GEMINI_PAYLOAD_FORMAT = os.getenv("GEMINI_PAYLOAD_FORMAT", "jpeg").lower()
     FAST_MODE = os.getenv("FAST_MODE", "false").lower() == "true"
     FAST_REFERENCE_MAX_SIZE = int(os.getenv("FAST_REFERENCE_MAX_SIZE", "256"))
 
@@ -40,12 +45,19 @@ class BaseConfig:
     CELERY_QUEUE_BG_REMOVE = os.getenv("CELERY_QUEUE_BG_REMOVE", "ivg_bg")
     CELERY_WORKER_AUTOSCALE_MIN = int(os.getenv("CELERY_WORKER_AUTOSCALE_MIN", "0"))
     CELERY_WORKER_AUTOSCALE_MAX = int(os.getenv("CELERY_WORKER_AUTOSCALE_MAX", "0"))
+    # Opt-in: switching backends drops existing sessions (and the history they scope).
+    SESSION_BACKEND = os.getenv("SESSION_BACKEND", "cookie").lower()
+    SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", CELERY_BROKER_URL)
 
     IMAGE_PROVIDER = os.getenv("IMAGE_PROVIDER", "nano_banana").lower()
     CLEANUP_ON_START = os.getenv("CLEANUP_ON_START", "false").lower() == "true"
     CLEANUP_MAX_AGE_MINUTES = int(os.getenv("CLEANUP_MAX_AGE_MINUTES", "0"))
     STYLE_RULES_MAX_CHARS = int(os.getenv("STYLE_RULES_MAX_CHARS", "4000"))
+    # zlib level for source images the pipeline re-encodes (0-9; 6 is Pillow's default).
+    PIPELINE_PNG_COMPRESS_LEVEL = int(os.getenv("PIPELINE_PNG_COMPRESS_LEVEL", "1"))
     DATABASE_URL = os.getenv("DATABASE_URL", "")
+    DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+    DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
     ASSET_TTL_UPLOAD_DAYS = int(os.getenv("ASSET_TTL_UPLOAD_DAYS", "14"))
     ASSET_TTL_RESULT_DAYS = int(os.getenv("ASSET_TTL_RESULT_DAYS", "30"))
     ASSET_TTL_BG_REMOVED_DAYS = int(os.getenv("ASSET_TTL_BG_REMOVED_DAYS", "30"))
@@ -53,9 +65,18 @@ class BaseConfig:
     HISTORY_TTL_DAYS = int(os.getenv("HISTORY_TTL_DAYS", "90"))
 
     BACKGROUND_REMOVAL_MODEL = os.getenv("BACKGROUND_REMOVAL_MODEL", "u2net")
+    # Local ONNX weights for custom rembg sessions (see scripts/quantize_rembg_model.py).
+    BACKGROUND_REMOVAL_MODEL_PATH = os.getenv("BACKGROUND_REMOVAL_MODEL_PATH", "")
     BACKGROUND_REMOVAL_LAZY_INIT = (
         os.getenv("BACKGROUND_REMOVAL_LAZY_INIT", "false").lower() == "true"
     )
+    # Celery children also load the non-default FAST_MODE model before taking jobs.
+    BACKGROUND_REMOVAL_PRELOAD_ALT = (
+        os.getenv("BACKGROUND_REMOVAL_PRELOAD_ALT", "false").lower() == "true"
+    )
+    # Opt-in worker processes for inline removal when async jobs are disabled; each loads
+    # its own copy of the model. 0 uses the threadpool.
+    BACKGROUND_REMOVAL_PROCESSES = int(os.getenv("BACKGROUND_REMOVAL_PROCESSES", "0"))
     BACKGROUND_REMOVAL_ALPHA_MATTING = (
         os.getenv("BACKGROUND_REMOVAL_ALPHA_MATTING", "true").lower() == "true"
     )
@@ -74,6 +95,7 @@ class BaseConfig:
     BACKGROUND_REMOVAL_MODEL_FAST = os.getenv(
         "BACKGROUND_REMOVAL_MODEL_FAST", "birefnet-general-lite"
     )
+    BACKGROUND_REMOVAL_MODEL_PATH_FAST = os.getenv("BACKGROUND_REMOVAL_MODEL_PATH_FAST", "")
     BACKGROUND_REMOVAL_FAST_ALPHA_MATTING = (
         os.getenv("BACKGROUND_REMOVAL_FAST_ALPHA_MATTING", "false").lower() == "true"
     )
@@ -97,10 +119,24 @@ class TestingConfig(BaseConfig):
     TESTING = True
 
 
+@lru_cache(maxsize=1)
 def get_config_class() -> type[BaseConfig]:
+    # APP_ENV is fixed for the life of the process, so resolve it once.
     env = os.getenv("APP_ENV", "development").lower()
     if env == "production":
         return ProductionConfig
     if env == "testing":
         return TestingConfig
     return DevelopmentConfig
+
+
+@lru_cache(maxsize=4)
+def config_snapshot(config_class: type[BaseConfig]) -> Mapping[str, object]:
+    """Returns a read-only mapping of the uppercase settings on a config class."""
+    snapshot: dict[str, object] = {}
+    # Walk class __dict__s along the MRO instead of dir(); the first definition wins.
+    for klass in config_class.__mro__:
+        for key, value in vars(klass).items():
+            if key.isupper() and key not in snapshot:
+                snapshot[key] = value
+    return MappingProxyType(snapshot)
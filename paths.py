@@ -2,15 +2,20 @@
 
 from __future__ import annotations
 
+from functools import lru_cache
 from pathlib import Path
 
-BASE_DIR = Path(__file__).resolve().parent
+# Module __file__ is already absolute, so skip the realpath syscalls of resolve().
+BASE_DIR = Path(__file__).parent
 STATIC_DIR = BASE_DIR / "static"
 RUNTIME_DIR = BASE_DIR / "runtime"
 UPLOAD_DIR = RUNTIME_DIR / "uploads"
 RESULT_DIR = RUNTIME_DIR / "results"
+TEMPLATE_CACHE_DIR = RUNTIME_DIR / "jinja_cache"
 
 
+@lru_cache(maxsize=1)
 def ensure_directories() -> None:
     UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
     RESULT_DIR.mkdir(parents=True, exist_ok=True)
+    TEMPLATE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
@@ -2,12 +2,16 @@
 
 from __future__ import annotations
 
-from fastapi import FastAPI
+from fastapi import APIRouter, FastAPI
 
 from .api import api_router
 from .web import web_router
 
+# Composed once at import so each app only includes a single router.
+root_router = APIRouter()
+root_router.include_router(web_router)
+root_router.include_router(api_router)
+
 
 def register_routes(app: FastAPI) -> None:
-    app.include_router(web_router)
-    app.include_router(api_router)
+    app.include_router(root_router)
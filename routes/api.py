@@ -3,60 +3,95 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import logging
-from typing import Optional
-from urllib.parse import urljoin
+import time
+from typing import AsyncIterator, Iterator, Optional
 
-from celery.result import AsyncResult
+import orjson
 from fastapi import APIRouter, File, Form, Query, Request, UploadFile
-from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from starlette.concurrency import run_in_threadpool
 
-try:
-    from paths import RESULT_DIR
-    from routes.utils import get_fast_mode, get_session_id, set_fast_mode
-    from celery_app import celery_app
-    from services import AppServices
-    from services.background_removal import BackgroundRemovalService
-    from services.image_assets import StorageError, extension_for_mime
-    from services.image_pipeline import AIProcessingError
-    from tasks import generate_variation_task, remove_background_task
-except ImportError:  # pragma: no cover
+# Parent-level modules are only reachable relatively when the app is imported as a package.
+if "." in (__package__ or ""):
     from ..paths import RESULT_DIR
     from .utils import get_fast_mode, get_session_id, set_fast_mode
     from ..celery_app import celery_app
     from ..services import AppServices
-    from ..services.background_removal import BackgroundRemovalService
+    from ..services.background_removal import remove_background_in_worker
     from ..services.image_assets import StorageError, extension_for_mime
     from ..services.image_pipeline import AIProcessingError
+    from ..services.job_events import build_job_event_listener
     from ..tasks import generate_variation_task, remove_background_task
+else:
+    from paths import RESULT_DIR
+    from routes.utils import get_fast_mode, get_session_id, set_fast_mode
+    from celery_app import celery_app
+    from services import AppServices
+    from services.background_removal import remove_background_in_worker
+    from services.image_assets import StorageError, extension_for_mime
+    from services.image_pipeline import AIProcessingError
+    from services.job_events import build_job_event_listener
+    from tasks import generate_variation_task, remove_background_task
 
 api_router = APIRouter(prefix="/api")
 logger = logging.getLogger(__name__)
 
+_FORM_CONTENT_TYPES = frozenset({"multipart/form-data", "application/x-www-form-urlencoded"})
+JOB_STREAM_POLL_INTERVAL = 1.5
+# With push notifications, polling is only a safety net for missed messages.
+JOB_STREAM_FALLBACK_INTERVAL = 15.0
+# Watchers of the same job share one backend read per TTL window.
+JOB_STATE_CACHE_TTL = 0.3
+JOB_STATE_CACHE_MAX_ENTRIES = 4096
+_TERMINAL_STATES = frozenset({"SUCCESS", "FAILURE", "REVOKED"})
+_job_state_cache: dict[str, tuple[float, str, object]] = {}
+
+
+def _invalidate_job_state(job_id: str) -> None:
+    _job_state_cache.pop(job_id, None)
+
+
+# A pushed state update drops the cached entry before woken streams re-read it.
+_job_events = build_job_event_listener(celery_app, on_update=_invalidate_job_state)
+
+
+def _base_url_str(request: Request) -> str:
+    # request.base_url rebuilds a URL object on every access; keep its string per request.
+    base_url = getattr(request.state, "base_url_str", None)
+    if base_url is None:
+        base_url = str(request.base_url)
+        request.state.base_url_str = base_url
+    return base_url
+
 
 def _absolute_url(request: Request, url: str) -> str:
     if url.startswith(("http://", "https://")):
         return url
-    return urljoin(str(request.base_url), url.lstrip("/"))
+    # base_url always ends with "/", so plain concatenation matches urljoin here.
+    return _base_url_str(request) + url.lstrip("/")
 
 
 @api_router.get("/health")
 def health_check() -> dict:
     return {"status": "ok"}
 
+# Celery states are already uppercase constants; anything unknown reads as pending.
+_STATE_MAP = {
+    "PENDING": "pending",
+    "RECEIVED": "pending",
+    "STARTED": "processing",
+    "RETRY": "processing",
+    "SUCCESS": "complete",
+    "FAILURE": "failed",
+    "REVOKED": "failed",
+}
+# Statuses after which a job's state never changes again.
+_FINAL_STATUSES = frozenset({"complete", "failed"})
+
+
 def _map_task_status(state: str) -> str:
-    normalized = (state or "").upper()
-    if normalized in {"PENDING", "RECEIVED"}:
-        return "pending"
-    if normalized in {"STARTED", "RETRY"}:
-        return "processing"
-    if normalized == "SUCCESS":
-        return "complete"
-    if normalized == "FAILURE":
-        return "failed"
-    return "pending"
+    return _STATE_MAP.get(state, "pending")
 
 
 def _format_variation_result(request: Request, payload: dict) -> dict:
@@ -92,50 +127,47 @@ def _format_background_result(request: Request, payload: dict) -> dict:
     }
 
 
-def _build_background_removal(app_config: object, fast_mode: bool) -> BackgroundRemovalService:
-    background_model = getattr(app_config, "BACKGROUND_REMOVAL_MODEL", "u2net")
-    alpha_matting = getattr(app_config, "BACKGROUND_REMOVAL_ALPHA_MATTING", True)
-    post_process = getattr(app_config, "BACKGROUND_REMOVAL_POST_PROCESS", True)
-    if fast_mode:
-        background_model = getattr(
-            app_config, "BACKGROUND_REMOVAL_MODEL_FAST", "birefnet-general-lite"
-        )
-        alpha_matting = getattr(app_config, "BACKGROUND_REMOVAL_FAST_ALPHA_MATTING", False)
-        post_process = getattr(app_config, "BACKGROUND_REMOVAL_FAST_POST_PROCESS", False)
-    return BackgroundRemovalService(
-        RESULT_DIR,
-        model_name=background_model,
-        alpha_matting=alpha_matting,
-        alpha_matting_foreground_threshold=getattr(
-            app_config, "BACKGROUND_REMOVAL_FG_THRESHOLD", 240
-        ),
-        alpha_matting_background_threshold=getattr(
-            app_config, "BACKGROUND_REMOVAL_BG_THRESHOLD", 10
-        ),
-        alpha_matting_erode_size=getattr(app_config, "BACKGROUND_REMOVAL_ERODE_SIZE", 10),
-        post_process_mask=post_process,
-        lazy_init=bool(getattr(app_config, "BACKGROUND_REMOVAL_LAZY_INIT", False)),
-    )
-
-
 @api_router.get("/jobs/{job_id}", name="api_job_status")
 def job_status(request: Request, job_id: str):
     return _build_job_payload(request, job_id)
 
 
 def _build_job_payload(request: Request, job_id: str) -> dict:
-    result = AsyncResult(job_id, app=celery_app)
-    status = _map_task_status(result.state)
+    state, info = _read_job_state(job_id)
+    return _payload_from_state(request, job_id, state, info)
+
+
+def _read_job_state(job_id: str) -> tuple[str, object]:
+    now = time.monotonic()
+    cached = _job_state_cache.get(job_id)
+    if cached is not None and cached[0] > now:
+        return cached[1], cached[2]
+
+    # One backend read yields both the state and the result/exception.
+    meta = celery_app.backend.get_task_meta(job_id)
+    state = meta.get("status") or "PENDING"
+    info = meta.get("result")
+    if state in _TERMINAL_STATES:
+        _job_state_cache.pop(job_id, None)
+    else:
+        if len(_job_state_cache) >= JOB_STATE_CACHE_MAX_ENTRIES:
+            _job_state_cache.clear()
+        _job_state_cache[job_id] = (now + JOB_STATE_CACHE_TTL, state, info)
+    return state, info
+
+
+def _payload_from_state(request: Request, job_id: str, state: str, info: object) -> dict:
+    status = _map_task_status(state)
     payload: dict[str, object] = {"job_id": job_id, "status": status}
 
     if status == "failed":
-        payload["error"] = str(result.info)
+        payload["error"] = "Job was cancelled." if state == "REVOKED" else str(info)
         return payload
 
     if status != "complete":
         return payload
 
-    result_payload = result.result or {}
+    result_payload = info or {}
     if isinstance(result_payload, dict) and result_payload.get("error"):
         payload["status"] = "failed"
         payload["error"] = result_payload.get("error")
@@ -156,26 +188,118 @@ def _build_job_payload(request: Request, job_id: str) -> dict:
     return payload
 
 
+class _JobBroadcast:
+    """Reads one job's state and fans encoded SSE frames out to every subscriber.
+
+    Streams for the same job and base URL share a broadcast, so each state
+    transition is read, formatted, and serialized once regardless of watchers.
+    """
+
+    def __init__(self, key: tuple[str, str], request: Request, interval: Optional[float]) -> None:
+        self._key = key
+        self._job_id = key[0]
+        # Only used for URL building, which is identical for every subscriber of this key.
+        self._request = request
+        self._interval = interval
+        self._subscribers: set[asyncio.Queue] = set()
+        self._last_frame: Optional[bytes] = None
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def subscribe(self, interval: Optional[float] = None) -> asyncio.Queue:
+        # The shared poll runs at the shortest interval any subscriber asked for.
+        if interval is not None and (self._interval is None or interval < self._interval):
+            self._interval = interval
+        queue: asyncio.Queue = asyncio.Queue()
+        if self._last_frame is not None:
+            queue.put_nowait(self._last_frame)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+        if not self._subscribers and not self._task.done():
+            # Unregister now so a reconnect in the meantime starts a fresh broadcast.
+            if _job_broadcasts.get(self._key) is self:
+                del _job_broadcasts[self._key]
+            self._task.cancel()
+
+    def _publish(self, frame: Optional[bytes]) -> None:
+        for queue in self._subscribers:
+            queue.put_nowait(frame)
+
+    async def _run(self) -> None:
+        job_id = self._job_id
+        last_state = None
+        wake = _job_events.subscribe(job_id) if _job_events else None
+        default_interval = JOB_STREAM_FALLBACK_INTERVAL if wake else JOB_STREAM_POLL_INTERVAL
+        try:
+            while True:
+                if wake is not None:
+                    wake.clear()
+                state, info = await run_in_threadpool(_read_job_state, job_id)
+                if state != last_state:
+                    # Only rebuild and serialize the payload when the task state moves.
+                    last_state = state
+                    payload = _payload_from_state(self._request, job_id, state, info)
+                    frame = b"data: " + orjson.dumps(payload) + b"\n\n"
+                    if frame != self._last_frame:
+                        self._last_frame = frame
+                        self._publish(frame)
+                    if payload.get("status") in _FINAL_STATUSES:
+                        # Results stay for result_expires: an expired id would read as
+                        # PENDING, which the backend cannot tell apart from a queued job.
+                        break
+                interval = self._interval or default_interval
+                if wake is None:
+                    await asyncio.sleep(interval)
+                    continue
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout=interval)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning("Job stream for %s failed: %s", job_id, exc)
+        finally:
+            if wake is not None:
+                _job_events.unsubscribe(job_id, wake)
+            if _job_broadcasts.get(self._key) is self:
+                del _job_broadcasts[self._key]
+            # Tell remaining subscribers the stream is over.
+            self._publish(None)
+
+
+_job_broadcasts: dict[tuple[str, str], _JobBroadcast] = {}
+
+
 @api_router.get("/jobs/{job_id}/stream", name="api_job_stream")
 async def job_stream(
     request: Request,
     job_id: str,
-    poll_interval: float = Query(default=1.5, ge=0.2, le=10),
+    poll_interval: Optional[float] = Query(default=None, ge=0.2, le=30),
 ):
+    key = (job_id, _base_url_str(request))
+
     async def event_generator():
-        last_payload = None
-        while True:
-            if await request.is_disconnected():
-                break
-            payload = _build_job_payload(request, job_id)
-            data = json.dumps(payload, ensure_ascii=True)
-            if data != last_payload:
-                # Only push updates when the payload changes.
-                yield f"data: {data}\n\n"
-                last_payload = data
-            if payload.get("status") in {"complete", "failed"}:
-                break
-            await asyncio.sleep(poll_interval)
+        broadcast = _job_broadcasts.get(key)
+        if broadcast is None:
+            broadcast = _JobBroadcast(key, request, poll_interval)
+            _job_broadcasts[key] = broadcast
+        queue = broadcast.subscribe(poll_interval)
+        try:
+            while True:
+                try:
+                    frame = await asyncio.wait_for(queue.get(), timeout=JOB_STREAM_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    continue
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            broadcast.unsubscribe(queue)
 
     headers = {
         "Cache-Control": "no-cache",
@@ -198,7 +322,7 @@ def list_styles(request: Request):
 @api_router.get("/styles/{style_id}/reference", name="api_style_reference")
 def style_reference(request: Request, style_id: str):
     services: AppServices = request.app.state.services
-    style = services.styles.get_style(style_id)
+    style = services.styles.get_style_meta(style_id)
     if not style:
         return JSONResponse({"error": "Style not found."}, status_code=404)
     reference_path = services.styles.materialize_reference(style, RESULT_DIR)
@@ -212,31 +336,60 @@ def list_history(request: Request, limit: Optional[int] = Query(default=None, ge
     services: AppServices = request.app.state.services
     session_id = get_session_id(request)
     entries = services.history.list_entries(session_id, limit=limit)
+    # Resolve the route once; entries only differ by image id.
+    url_prefix, _, url_suffix = str(
+        request.url_for("api_image_asset", image_id="__image_id__")
+    ).partition("__image_id__")
     history = []
     for entry in entries:
-        result_url = request.url_for("api_image_asset", image_id=entry.result_id)
-        original_url = _absolute_url(request, entry.original_url) if entry.original_url else result_url
+        result_url = f"{url_prefix}{entry.result_id}{url_suffix}"
+        original_url = (
+            _absolute_url(request, entry.original_url)
+            if entry.original_url
+            else result_url
+        )
         history.append(
             {
                 "result_id": entry.result_id,
-                "result_url": str(result_url),
-                "original_url": str(original_url),
+                "result_url": result_url,
+                "original_url": original_url,
                 "created_at": entry.created_at.isoformat(),
             }
         )
     return {"history": history}
 
 
+async def _stream_chunks(chunks: Iterator[bytes]) -> AsyncIterator[bytes]:
+    try:
+        while True:
+            chunk = await run_in_threadpool(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # Runs on client disconnect too. A slice still being read in the threadpool
+        # cannot be closed from here, but it returns its connection when it finishes.
+        try:
+            chunks.close()
+        except ValueError:
+            pass
+
+
 @api_router.get("/images/{image_id}", name="api_image_asset")
-def image_asset(request: Request, image_id: str):
+async def image_asset(request: Request, image_id: str):
     session_id = get_session_id(request)
     services: AppServices = request.app.state.services
-    asset = services.assets.get_asset(session_id, image_id)
+    asset = await run_in_threadpool(services.assets.open_asset_stream, session_id, image_id)
     if not asset:
         return JSONResponse({"error": "Image not found."}, status_code=404)
     download_name = asset.filename or f"image{extension_for_mime(asset.content_type)}"
-    headers = {"Content-Disposition": f'inline; filename="{download_name}"'}
-    return Response(content=asset.image_bytes, media_type=asset.content_type, headers=headers)
+    headers = {
+        "Content-Disposition": f'inline; filename="{download_name}"',
+        "Content-Length": str(asset.size),
+    }
+    return StreamingResponse(
+        _stream_chunks(asset.chunks), media_type=asset.content_type, headers=headers
+    )
 
 
 @api_router.post("/variations")
@@ -264,12 +417,11 @@ async def create_variation(
     upload_asset_id = None
     if image and image.filename:
         try:
-            payload = await image.read()
             stored = await run_in_threadpool(
-                services.assets.save_upload_bytes,
+                services.assets.save_upload_stream,
                 filename=image.filename,
                 content_type=image.content_type,
-                image_bytes=payload,
+                stream=image.file,
                 session_id=session_id,
             )
             upload_asset_id = stored.asset_id
@@ -315,18 +467,18 @@ async def remove_background(request: Request):
     session_id = get_session_id(request)
     jobs_enabled = bool(getattr(app_config, "ASYNC_TASKS_ENABLED", True))
     resolved_id = ""
-    try:
+    # Pick the body parser from the declared content type instead of trying each in turn.
+    content_type = request.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+    if content_type in _FORM_CONTENT_TYPES:
         form = await request.form()
         resolved_id = str(form.get("image_id") or "").strip()
-    except Exception:
-        pass
-    if not resolved_id:
+    elif content_type == "application/json" or content_type.endswith("+json"):
         try:
             payload = await request.json()
-            if isinstance(payload, dict):
-                resolved_id = str(payload.get("image_id") or "").strip()
-        except Exception:
-            pass
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict):
+            resolved_id = str(payload.get("image_id") or "").strip()
     if not resolved_id:
         resolved_id = (request.query_params.get("image_id") or "").strip()
     if not resolved_id:
@@ -351,7 +503,7 @@ async def remove_background(request: Request):
     services: AppServices = request.app.state.services
     removal_service = services.background_removal
     if fast_mode_flag != bool(getattr(app_config, "FAST_MODE", False)):
-        removal_service = _build_background_removal(app_config, fast_mode_flag)
+        removal_service = services.background_removal_alt
     if not removal_service.available:
         return JSONResponse({"error": "Background removal unavailable."}, status_code=503)
 
@@ -359,25 +511,30 @@ async def remove_background(request: Request):
     if not asset:
         return JSONResponse({"error": "Result image not found."}, status_code=404)
 
-    output_bytes = await run_in_threadpool(
-        removal_service.remove_background_bytes, asset.image_bytes
-    )
+    bg_pool = request.app.state.bg_pool
+    if bg_pool is not None:
+        # Inference is CPU-bound, so it runs in worker processes rather than threads.
+        output_bytes = await asyncio.get_running_loop().run_in_executor(
+            bg_pool, remove_background_in_worker, asset.image_bytes, fast_mode_flag
+        )
+    else:
+        output_bytes = await run_in_threadpool(
+            removal_service.remove_background_bytes, asset.image_bytes
+        )
     if not output_bytes:
         return JSONResponse({"error": "Background removal failed."}, status_code=500)
 
+    original_url = f"/api/images/{asset.asset_id}"
     output_id = await run_in_threadpool(
-        services.assets.save_bytes,
+        services.assets.save_bytes_with_history,
+        services.history,
         session_id,
         output_bytes,
         "image/png",
+        original_url,
         None,
         "bg_removed",
     )
-    original_url = f"/api/images/{asset.asset_id}"
-    try:
-        await run_in_threadpool(services.history.add_entry, session_id, output_id, original_url)
-    except Exception:
-        pass
 
     result_payload = {
         "job_type": "background_removal",
@@ -0,0 +1,114 @@
+"""In-memory static asset serving for small frontend files."""
+
+from __future__ import annotations
+
+import gzip
+import mimetypes
+import os
+from dataclasses import dataclass
+from email.utils import formatdate
+from pathlib import Path
+from typing import Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+MAX_CACHED_ASSET_BYTES = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class PrecomputedAsset:
+    body: bytes
+    gzip_body: Optional[bytes]
+    etag: str
+    # The gzip body is a different representation, so it needs its own strong ETag.
+    gzip_etag: str
+    last_modified: str
+    content_type: str
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that serves small assets from RAM and large ones from disk.
+
+    The RAM snapshot is taken once, so callers disable it where files change under a
+    running server (development), and every asset is then read from disk.
+    """
+
+    def __init__(
+        self,
+        directory: str | Path,
+        max_cached_bytes: int = MAX_CACHED_ASSET_BYTES,
+        cache_in_memory: bool = True,
+    ) -> None:
+        super().__init__(directory=directory)
+        self._assets = _load_assets(Path(directory), max_cached_bytes) if cache_in_memory else {}
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        asset = self._assets.get(path.replace(os.sep, "/"))
+        if asset is None or scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+
+        request_headers = Headers(scope=scope)
+        use_gzip = asset.gzip_body is not None and _accepts_gzip(
+            request_headers.get("accept-encoding", "")
+        )
+        headers = {
+            "etag": asset.gzip_etag if use_gzip else asset.etag,
+            "last-modified": asset.last_modified,
+            "vary": "Accept-Encoding",
+        }
+        if self.is_not_modified(headers, request_headers):
+            return Response(status_code=304, headers=headers)
+
+        body = asset.body
+        if use_gzip:
+            body = asset.gzip_body
+            headers["content-encoding"] = "gzip"
+        return Response(content=body, media_type=asset.content_type, headers=headers)
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    # Honour q-values, so "gzip;q=0" is a refusal rather than a match.
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        if coding.strip().lower() != "gzip":
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        return quality > 0
+    return False
+
+
+def _load_assets(directory: Path, max_cached_bytes: int) -> dict[str, PrecomputedAsset]:
+    # Read small assets once at startup; only used where they do not change at runtime.
+    assets: dict[str, PrecomputedAsset] = {}
+    if not directory.is_dir():
+        return assets
+    for file_path in directory.rglob("*"):
+        if not file_path.is_file():
+            continue
+        stat = file_path.stat()
+        if stat.st_size > max_cached_bytes:
+            continue
+        body = file_path.read_bytes()
+        compressed = gzip.compress(body)
+        content_type = mimetypes.guess_type(file_path.name)[0] or "application/octet-stream"
+        if content_type.startswith("text/"):
+            content_type = f"{content_type}; charset=utf-8"
+        etag = f'"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+        assets[file_path.relative_to(directory).as_posix()] = PrecomputedAsset(
+            body=body,
+            gzip_body=compressed if len(compressed) < len(body) else None,
+            etag=etag,
+            gzip_etag=etag[:-1] + '-gz"',
+            last_modified=formatdate(stat.st_mtime, usegmt=True),
+            content_type=content_type,
+        )
+    return assets
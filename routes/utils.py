@@ -2,8 +2,9 @@
 
 from __future__ import annotations
 
-from pathlib import Path
-from uuid import uuid4
+import os
+import threading
+from collections import deque
 
 from starlette.requests import Request
 
@@ -11,12 +12,27 @@ SESSION_ID_KEY = "session_id"
 FLASH_KEY = "flash_messages"
 FAST_MODE_KEY = "fast_mode"
 
+UID_POOL_SIZE = 1024
+_uid_pool: deque[str] = deque()
+_uid_pool_lock = threading.Lock()
+# Forked workers must not hand out ids already drawn by the parent.
+os.register_at_fork(after_in_child=_uid_pool.clear)
+
+
+def fast_uid() -> str:
+    """Returns a random 32-char hex id, drawing entropy in batches of UID_POOL_SIZE."""
+    with _uid_pool_lock:
+        if not _uid_pool:
+            entropy = os.urandom(16 * UID_POOL_SIZE).hex()
+            _uid_pool.extend(entropy[i : i + 32] for i in range(0, len(entropy), 32))
+        return _uid_pool.popleft()
+
 
 def get_session_id(request: Request) -> str:
     # Create a stable session id for history and asset scoping.
     session_id = request.session.get(SESSION_ID_KEY)
     if not session_id:
-        session_id = uuid4().hex
+        session_id = fast_uid()
         request.session[SESSION_ID_KEY] = session_id
     return session_id
 
@@ -38,10 +54,3 @@ def set_fast_mode(request: Request, enabled: bool) -> None:
 
 def get_fast_mode(request: Request, default: bool = False) -> bool:
     return bool(request.session.get(FAST_MODE_KEY, default))
-
-
-def write_temp_image(temp_dir: Path, stem: str, suffix: str, payload: bytes) -> Path:
-    safe_suffix = suffix if suffix.startswith(".") else f".{suffix}"
-    path = temp_dir / f"{stem}{safe_suffix}"
-    path.write_bytes(payload)
-    return path
@@ -4,92 +4,110 @@ from __future__ import annotations
 
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Optional
-from uuid import uuid4
+from typing import Mapping, Optional
 
 import logging
 
 from fastapi import APIRouter, File, Form, Request, UploadFile
-from fastapi.responses import RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 
-try:
-    from paths import RESULT_DIR
-    from routes.utils import (
+# Parent-level modules are only reachable relatively when the app is imported as a package.
+if "." in (__package__ or ""):
+    from ..paths import RESULT_DIR
+    from .utils import (
         add_flash,
+        fast_uid,
         get_fast_mode,
         get_session_id,
         pop_flashes,
         set_fast_mode,
-        write_temp_image,
     )
-    from services import AppServices
-    from services.ai import build_image_editor
-    from services.image_assets import StorageError, extension_for_mime
-    from services.image_pipeline import AIProcessingError, ImagePipeline
-except ImportError:  # pragma: no cover
-    from ..paths import RESULT_DIR
-    from .utils import (
+    from ..services import AppServices
+    from ..services.ai import describe_editor
+    from ..services.image_assets import StorageError, StoredUpload
+    from ..services.image_pipeline import AIProcessingError, select_pipeline
+else:
+    from paths import RESULT_DIR
+    from routes.utils import (
         add_flash,
+        fast_uid,
         get_fast_mode,
         get_session_id,
         pop_flashes,
         set_fast_mode,
-        write_temp_image,
     )
-    from ..services import AppServices
-    from ..services.ai import build_image_editor
-    from ..services.image_assets import StorageError, extension_for_mime
-    from ..services.image_pipeline import AIProcessingError, ImagePipeline
+    from services import AppServices
+    from services.ai import describe_editor
+    from services.image_assets import StorageError, StoredUpload
+    from services.image_pipeline import AIProcessingError, select_pipeline
 
 web_router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
-def _resolve_ai_metadata(config: dict, fast_mode: bool) -> tuple[str, str]:
-    provider = str(config.get("IMAGE_PROVIDER", "nano_banana")).lower()
-    if provider == "nano_banana":
-        model_name = config.get("GEMINI_MODEL", "gemini-3-pro-image-preview")
-        if fast_mode:
-            model_name = config.get("GEMINI_MODEL_FAST", "gemini-2.5-flash-image")
-        label_map = {
-            "gemini-3-pro-image-preview": "Gemini 3 Pro Image Preview",
-            "gemini-2.5-flash-image": "Gemini 2.5 Flash Image",
-        }
-        model_label = label_map.get(model_name, model_name)
-        return f"Nano Banana ({model_label})", "nano"
-    return "AI", "ai"
-
+def _resolve_ai_metadata(config: Mapping[str, object], fast_mode: bool) -> tuple[str, str]:
+    provider = str(config.get("IMAGE_PROVIDER", "nano_banana"))
+    if fast_mode:
+        model_name = str(config.get("GEMINI_MODEL_FAST", "gemini-2.5-flash-image"))
+    else:
+        model_name = str(config.get("GEMINI_MODEL", "gemini-3-pro-image-preview"))
+    # The index page resolves the label on every render; describe_editor memoizes it.
+    return describe_editor(provider, model_name)
 
-def _select_pipeline(
-    app_config: object, base_pipeline: ImagePipeline, fast_mode: bool
-) -> ImagePipeline:
-    default_fast = bool(getattr(app_config, "FAST_MODE", False))
-    if fast_mode == default_fast:
-        return base_pipeline
 
-    config_values = {key: getattr(app_config, key) for key in dir(app_config) if key.isupper()}
-    config_values["FAST_MODE"] = fast_mode
-    editor = build_image_editor(config_values)
-    ai_label, ai_suffix = _resolve_ai_metadata(config_values, fast_mode)
-    return ImagePipeline(result_dir=RESULT_DIR, editor=editor, ai_label=ai_label, ai_suffix=ai_suffix)
+def _store_upload(
+    services: AppServices, image: UploadFile, session_id: str, upload_path: Path
+) -> StoredUpload:
+    # Tee the upload into the temp file while it streams to storage.
+    with upload_path.open("wb") as temp_file:
+        return services.assets.save_upload_stream(
+            filename=image.filename,
+            content_type=image.content_type,
+            stream=image.file,
+            session_id=session_id,
+            copy_to=temp_file,
+        )
 
 
 def _get_templates(request: Request) -> Jinja2Templates:
     return request.app.state.templates
 
 
+# Rendered landing pages for requests without flash messages.
+INDEX_CACHE_MAX_ENTRIES = 64
+_INDEX_CACHE: dict[tuple[str, bool, str, bool, bool], str] = {}
+
+
 @web_router.get("/", name="web_index")
 def index(request: Request):
     services: AppServices = request.app.state.services
     app_config = request.app.state.config
-    config_values = {key: getattr(app_config, key) for key in dir(app_config) if key.isupper()}
+    config_values = request.app.state.config_values
     fast_mode_checked = get_fast_mode(request, bool(getattr(app_config, "FAST_MODE", False)))
     ai_label, _ = _resolve_ai_metadata(config_values, fast_mode_checked)
     jobs_enabled = bool(getattr(app_config, "ASYNC_TASKS_ENABLED", True))
+    nano_available = services.pipeline.ai_available
+    messages = pop_flashes(request)
+    templates = _get_templates(request)
+    # The page only varies by these inputs, so renders are reused unless templates auto-reload.
+    cache_key = None
+    if not messages and not templates.env.auto_reload:
+        cache_key = (
+            str(request.base_url),
+            nano_available,
+            ai_label,
+            fast_mode_checked,
+            jobs_enabled,
+        )
+        cached = _INDEX_CACHE.get(cache_key)
+        if cached is not None:
+            return HTMLResponse(cached)
+
     context = {
         "request": request,
-        "nano_available": services.pipeline.ai_available,
+        "nano_available": nano_available,
         "ai_label": ai_label,
         "result_url": None,
         "result_id": None,
@@ -101,10 +119,17 @@ def index(request: Request):
         "use_previous_checked": False,
         "fast_mode_checked": fast_mode_checked,
         "source_image_id": "",
-        "messages": pop_flashes(request),
+        "messages": messages,
         "jobs_enabled": jobs_enabled,
     }
-    return _get_templates(request).TemplateResponse("index.html", context)
+    if cache_key is None:
+        return templates.TemplateResponse("index.html", context)
+
+    html = templates.get_template("index.html").render(context)
+    if len(_INDEX_CACHE) >= INDEX_CACHE_MAX_ENTRIES:
+        _INDEX_CACHE.clear()
+    _INDEX_CACHE[cache_key] = html
+    return HTMLResponse(html)
 
 
 @web_router.post("/")
@@ -129,15 +154,32 @@ async def create_variation(
     )
     set_fast_mode(request, fast_mode_flag)
     app_config = request.app.state.config
-    pipeline = _select_pipeline(app_config, services.pipeline, fast_mode_flag)
+    pipeline = select_pipeline(
+        request.app.state.config_values, services.pipeline, fast_mode_flag
+    )
 
-    uid = uuid4().hex
-    style = services.styles.get_style(style_id) if style_id else None
-    if style_id and not style:
-        add_flash(request, "Selected style not found.")
-        return RedirectResponse(url=str(request.url_for("web_index")), status_code=303)
+    uid = fast_uid()
+    # Storage, style, and pipeline calls block, so they run off the event loop.
+    prompt = prompt.strip()
+    style_bundle = None
+    if style_id:
+        # The reference image is needed for the AI edit or when the style is the source.
+        style_is_source = not (
+            (image and image.filename)
+            or (use_previous_flag and previous_result)
+            or (regenerate_flag and source_image_id)
+        )
+        style_bundle = await run_in_threadpool(
+            services.styles.get_style_bundle,
+            style_id,
+            include_reference=bool(prompt) or style_is_source,
+        )
+        if not style_bundle:
+            add_flash(request, "Selected style not found.")
+            return RedirectResponse(url=str(request.url_for("web_index")), status_code=303)
+    style = style_bundle.style if style_bundle else None
 
-    source_path = None
+    source: Path | bytes | None = None
     original_url = None
     source_asset_id = ""
 
@@ -145,40 +187,39 @@ async def create_variation(
         temp_path = Path(temp_dir)
         if image and image.filename:
             try:
-                payload = await image.read()
-                stored = services.assets.save_upload_bytes(
-                    filename=image.filename,
-                    content_type=image.content_type,
-                    image_bytes=payload,
-                    session_id=session_id,
+                upload_path = temp_path / uid
+                stored = await run_in_threadpool(
+                    _store_upload, services, image, session_id, upload_path
                 )
             except StorageError as exc:
                 add_flash(request, str(exc))
                 return RedirectResponse(url=str(request.url_for("web_index")), status_code=303)
-            source_path = write_temp_image(temp_path, uid, stored.suffix, stored.image_bytes)
+            source = upload_path.rename(temp_path / f"{uid}{stored.suffix}")
             original_url = request.url_for("api_image_asset", image_id=stored.asset_id)
             source_asset_id = stored.asset_id
         elif use_previous_flag and previous_result:
-            asset = services.assets.get_asset(session_id, previous_result)
+            asset = await run_in_threadpool(services.assets.get_asset, session_id, previous_result)
             if not asset:
                 add_flash(request, "Previous result not found.")
                 return RedirectResponse(url=str(request.url_for("web_index")), status_code=303)
-            suffix = extension_for_mime(asset.content_type)
-            source_path = write_temp_image(temp_path, uid, suffix, asset.image_bytes)
+            # Stored assets go to the pipeline as bytes instead of through a temp file.
+            source = asset.image_bytes
             original_url = request.url_for("api_image_asset", image_id=asset.asset_id)
             source_asset_id = asset.asset_id
         elif regenerate_flag and source_image_id:
-            asset = services.assets.get_asset(session_id, source_image_id)
+            asset = await run_in_threadpool(services.assets.get_asset, session_id, source_image_id)
             if not asset:
                 add_flash(request, "Source image not found for regenerate.")
                 return RedirectResponse(url=str(request.url_for("web_index")), status_code=303)
-            suffix = extension_for_mime(asset.content_type)
-            source_path = write_temp_image(temp_path, uid, suffix, asset.image_bytes)
+            # Stored assets go to the pipeline as bytes instead of through a temp file.
+            source = asset.image_bytes
             original_url = request.url_for("api_image_asset", image_id=asset.asset_id)
             source_asset_id = asset.asset_id
         elif style:
-            source_path = services.styles.materialize_reference(style, RESULT_DIR)
-            if not source_path.is_file():
+            source = await run_in_threadpool(
+                services.styles.materialize_reference, style, RESULT_DIR
+            )
+            if not source.is_file():
                 add_flash(request, "Style reference unavailable.")
                 return RedirectResponse(url=str(request.url_for("web_index")), status_code=303)
             original_url = request.url_for("api_style_reference", style_id=style.style_id)
@@ -186,32 +227,32 @@ async def create_variation(
             add_flash(request, "Upload an image, enable forward generation, or select a style.")
             return RedirectResponse(url=str(request.url_for("web_index")), status_code=303)
 
-        style_rules = services.styles.load_rules(style) if style else None
-        style_reference_bytes = style.reference_bytes if style else None
+        style_rules = style_bundle.rules if style_bundle else None
+        # The reference image only feeds the AI edit, so it is not passed without a prompt.
+        style_reference_bytes = style_bundle.reference_bytes if style_bundle and prompt else None
         try:
-            result = pipeline.process(
-                source_path,
-                prompt.strip(),
+            result = await run_in_threadpool(
+                pipeline.process,
+                source,
+                prompt,
                 uid,
                 style_rules,
                 style_reference_bytes=style_reference_bytes,
-                result_dir=temp_path,
             )
         except AIProcessingError as exc:
             add_flash(request, str(exc))
             return RedirectResponse(url=str(request.url_for("web_index")), status_code=303)
-        result_bytes = result.result_path.read_bytes()
-        result_id = services.assets.save_bytes(
+        # The asset and its history entry commit together in one transaction.
+        result_id = await run_in_threadpool(
+            services.assets.save_bytes_with_history,
+            services.history,
             session_id,
-            result_bytes,
+            result.result_bytes,
             "image/png",
+            str(original_url) if original_url else None,
             filename=f"{uid}.png",
             role="result",
         )
-    try:
-        services.history.add_entry(session_id, result_id, str(original_url) if original_url else None)
-    except Exception as exc:
-        logger.warning("Failed to record history: %s", exc)
 
     if result.warning_message:
         add_flash(request, result.warning_message)
@@ -16,8 +16,103 @@ def _get_int(name: str, default: int) -> int:
         return default
 
 
-def _interval(days: int) -> str:
-    return f"{days} days"
+def _interval(days: int) -> str | None:
+    # Non-positive TTLs disable the matching rule; NULL intervals match no rows.
+    return f"{days} days" if days > 0 else None
+
+
+ENSURE_RETENTION_COLUMNS = """
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'image_assets' AND column_name = 'last_accessed'
+    ) THEN
+        ALTER TABLE image_assets ADD COLUMN last_accessed TIMESTAMPTZ;
+    END IF;
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'image_assets' AND column_name = 'deleted_at'
+    ) THEN
+        ALTER TABLE image_assets ADD COLUMN deleted_at TIMESTAMPTZ;
+    END IF;
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'image_assets' AND column_name = 'pinned'
+    ) THEN
+        ALTER TABLE image_assets ADD COLUMN pinned BOOLEAN NOT NULL DEFAULT FALSE;
+    END IF;
+END
+$$
+"""
+
+# CONCURRENTLY cannot run inside a transaction, so these go out in autocommit mode.
+RETENTION_INDEXES = (
+    """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS image_assets_retention_idx
+    ON image_assets (role, created_at)
+    WHERE deleted_at IS NULL AND pinned IS NOT TRUE
+    """,
+    """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS generation_history_result_idx
+    ON generation_history (result_id)
+    """,
+)
+
+# All CTEs share one snapshot, so the soft-delete and purge sets never overlap.
+RETENTION_SQL = """
+WITH upd_upload AS (
+    UPDATE image_assets
+    SET deleted_at = NOW()
+    WHERE deleted_at IS NULL
+      AND pinned IS NOT TRUE
+      AND role = 'upload'
+      AND created_at < NOW() - %(upload_ttl)s::interval
+    RETURNING 1
+),
+upd_result AS (
+    UPDATE image_assets
+    SET deleted_at = NOW()
+    WHERE deleted_at IS NULL
+      AND pinned IS NOT TRUE
+      AND role = 'result'
+      AND created_at < NOW() - %(result_ttl)s::interval
+      AND NOT EXISTS (
+          SELECT 1 FROM generation_history gh
+          WHERE gh.result_id = image_assets.id
+          LIMIT 1
+      )
+    RETURNING 1
+),
+upd_bg AS (
+    UPDATE image_assets
+    SET deleted_at = NOW()
+    WHERE deleted_at IS NULL
+      AND pinned IS NOT TRUE
+      AND role = 'bg_removed'
+      AND created_at < NOW() - %(bg_ttl)s::interval
+      AND NOT EXISTS (
+          SELECT 1 FROM generation_history gh
+          WHERE gh.result_id = image_assets.id
+          LIMIT 1
+      )
+    RETURNING 1
+),
+del_grace AS (
+    DELETE FROM image_assets
+    WHERE deleted_at IS NOT NULL
+      AND deleted_at < NOW() - %(grace)s::interval
+    RETURNING 1
+)
+SELECT
+    (SELECT count(*) FROM upd_upload),
+    (SELECT count(*) FROM upd_result),
+    (SELECT count(*) FROM upd_bg),
+    (SELECT count(*) FROM del_grace)
+"""
 
 
 def main() -> int:
@@ -35,78 +130,40 @@ def main() -> int:
     history_ttl = _get_int("HISTORY_TTL_DAYS", 90)
 
     with psycopg.connect(db_url, autocommit=True) as conn:
-        # Ensure retention columns exist for older databases.
-        conn.execute("ALTER TABLE image_assets ADD COLUMN IF NOT EXISTS last_accessed TIMESTAMPTZ")
-        conn.execute("ALTER TABLE image_assets ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ")
-        conn.execute(
-            "ALTER TABLE image_assets ADD COLUMN IF NOT EXISTS pinned BOOLEAN NOT NULL DEFAULT FALSE"
-        )
-
-        if history_ttl > 0:
-            # Remove old history rows outright.
-            conn.execute(
-                "DELETE FROM generation_history WHERE created_at < NOW() - (%s::interval)",
-                (_interval(history_ttl),),
-            )
-
-        if upload_ttl > 0:
-            conn.execute(
-                """
-                UPDATE image_assets
-                SET deleted_at = NOW()
-                WHERE deleted_at IS NULL
-                  AND pinned IS NOT TRUE
-                  AND role = 'upload'
-                  AND created_at < NOW() - (%s::interval)
-                """,
-                (_interval(upload_ttl),),
-            )
-
-        if result_ttl > 0:
-            conn.execute(
-                """
-                UPDATE image_assets
-                SET deleted_at = NOW()
-                WHERE deleted_at IS NULL
-                  AND pinned IS NOT TRUE
-                  AND role = 'result'
-                  AND created_at < NOW() - (%s::interval)
-                  AND NOT EXISTS (
-                      SELECT 1 FROM generation_history gh
-                      WHERE gh.result_id = image_assets.id
-                  )
-                """,
-                (_interval(result_ttl),),
-            )
-
-        if bg_ttl > 0:
-            conn.execute(
-                """
-                UPDATE image_assets
-                SET deleted_at = NOW()
-                WHERE deleted_at IS NULL
-                  AND pinned IS NOT TRUE
-                  AND role = 'bg_removed'
-                  AND created_at < NOW() - (%s::interval)
-                  AND NOT EXISTS (
-                      SELECT 1 FROM generation_history gh
-                      WHERE gh.result_id = image_assets.id
-                  )
-                """,
-                (_interval(bg_ttl),),
-            )
-
-        if grace_days > 0:
-            conn.execute(
-                """
-                DELETE FROM image_assets
-                WHERE deleted_at IS NOT NULL
-                  AND deleted_at < NOW() - (%s::interval)
-                """,
-                (_interval(grace_days),),
-            )
-
-    print("Retention cleanup complete.")
+        # Ensure retention columns and sweep indexes exist for older databases.
+        conn.execute(ENSURE_RETENTION_COLUMNS)
+        for statement in RETENTION_INDEXES:
+            conn.execute(statement)
+
+        with conn.transaction():
+            history_deleted = 0
+            if history_ttl > 0:
+                # Remove old history rows first so their results become eligible below.
+                history_deleted = conn.execute(
+                    "DELETE FROM generation_history WHERE created_at < NOW() - (%s::interval)",
+                    (_interval(history_ttl),),
+                ).rowcount
+
+            uploads, results, bg_removed, purged = conn.execute(
+                RETENTION_SQL,
+                {
+                    "upload_ttl": _interval(upload_ttl),
+                    "result_ttl": _interval(result_ttl),
+                    "bg_ttl": _interval(bg_ttl),
+                    "grace": _interval(grace_days),
+                },
+            ).fetchone()
+
+        # Refresh planner statistics and reclaim dead tuples left by the sweep.
+        conn.execute("VACUUM (ANALYZE) image_assets")
+        conn.execute("VACUUM (ANALYZE) generation_history")
+
+    print(
+        "Retention cleanup complete: "
+        f"{history_deleted} history rows deleted, "
+        f"{uploads} uploads, {results} results, {bg_removed} bg_removed soft-deleted, "
+        f"{purged} assets purged."
+    )
     return 0
 
 
@@ -0,0 +1,139 @@
+"""Schema DDL shared by the database setup and migration scripts."""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import psycopg
+
+# Bump whenever SCHEMA_SQL changes.
+SCHEMA_VERSION = 6
+
+SCHEMA_SQL: tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS image_assets (
+        id UUID PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        filename TEXT,
+        content_type TEXT NOT NULL,
+        image_bytes BYTEA NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        last_accessed TIMESTAMPTZ,
+        deleted_at TIMESTAMPTZ,
+        pinned BOOLEAN NOT NULL DEFAULT FALSE,
+        content_hash BYTEA
+    )
+    """,
+    # PNG/JPEG/WEBP payloads do not compress; EXTERNAL skips the pglz attempt on write.
+    "ALTER TABLE image_assets ALTER COLUMN image_bytes SET STORAGE EXTERNAL",
+    """
+    CREATE INDEX IF NOT EXISTS image_assets_session_idx
+    ON image_assets (session_id)
+    """,
+    """
+    ALTER TABLE image_assets
+        ADD COLUMN IF NOT EXISTS last_accessed TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS pinned BOOLEAN NOT NULL DEFAULT FALSE,
+        ADD COLUMN IF NOT EXISTS content_hash BYTEA
+    """,
+    # Generated results are deduplicated per session by payload digest.
+    """
+    CREATE INDEX IF NOT EXISTS image_assets_content_hash_idx
+    ON image_assets (session_id, content_hash)
+    WHERE content_hash IS NOT NULL
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS image_assets_cleanup_idx
+    ON image_assets (deleted_at, role, created_at)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS image_assets_retention_idx
+    ON image_assets (role, created_at)
+    WHERE deleted_at IS NULL AND pinned IS NOT TRUE
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS generation_history (
+        id UUID PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        result_id UUID NOT NULL,
+        original_url TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS generation_history_session_idx
+    ON generation_history (session_id, created_at)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS generation_history_result_idx
+    ON generation_history (result_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS styles (
+        style_id TEXT PRIMARY KEY,
+        style_name TEXT NOT NULL,
+        rules_text TEXT NOT NULL,
+        reference_image BYTEA NOT NULL,
+        reference_mime TEXT NOT NULL,
+        style_profile TEXT
+    )
+    """,
+    "ALTER TABLE styles ADD COLUMN IF NOT EXISTS style_profile TEXT",
+    "ALTER TABLE styles ALTER COLUMN reference_image SET STORAGE EXTERNAL",
+    # Covers list_styles (ORDER BY style_name, returning style_id) as an index-only scan.
+    """
+    CREATE INDEX IF NOT EXISTS styles_name_idx
+    ON styles (style_name) INCLUDE (style_id)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        version INTEGER NOT NULL
+    )
+    """,
+)
+
+# Text columns that do compress decompress faster with LZ4 (Postgres 14+, built with lz4).
+_LZ4_SQL = """
+    DO $$
+    BEGIN
+        ALTER TABLE styles
+            ALTER COLUMN rules_text SET COMPRESSION lz4,
+            ALTER COLUMN style_profile SET COMPRESSION lz4;
+    EXCEPTION WHEN feature_not_supported THEN
+        NULL;
+    END
+    $$
+"""
+_LZ4_MIN_SERVER_VERSION = 140000
+
+_RECORD_VERSION_SQL = """
+    INSERT INTO schema_version (id, version) VALUES (TRUE, %s)
+    ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version
+"""
+
+
+def schema_is_current(conn: psycopg.Connection) -> bool:
+    row = conn.execute("SELECT to_regclass('schema_version')").fetchone()
+    if not row or row[0] is None:
+        return False
+    row = conn.execute("SELECT version FROM schema_version LIMIT 1").fetchone()
+    return bool(row) and row[0] == SCHEMA_VERSION
+
+
+def ensure_schema(conn: psycopg.Connection) -> bool:
+    """Apply SCHEMA_SQL unless the version sentinel matches; returns whether DDL ran."""
+    if schema_is_current(conn):
+        return False
+
+    # Pipeline mode sends the whole DDL chain in one network flight.
+    with conn.pipeline():
+        for statement in SCHEMA_SQL:
+            conn.execute(statement)
+        if conn.info.server_version >= _LZ4_MIN_SERVER_VERSION:
+            conn.execute(_LZ4_SQL)
+        conn.execute(_RECORD_VERSION_SQL, (SCHEMA_VERSION,))
+    return True
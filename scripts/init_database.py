@@ -2,20 +2,34 @@
 
 from __future__ import annotations
 
+import hashlib
+import io
 import json
+import mmap
 import os
+import shutil
+import subprocess
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
+from typing import Iterable
 
-import psycopg
-from psycopg import conninfo
-from dotenv import load_dotenv
-from PyPDF2 import PdfReader
+from db_schema import ensure_schema
+
+try:
+    import ijson
+except ImportError:  # pragma: no cover
+    ijson = None
 
 
 STYLE_GUIDES_DIR = Path("style_guides")
 STYLE_IMAGES_DIR = Path("style_images")
+STYLE_GUIDE_CACHE_DIR = Path(".cache") / "style_guides"
 CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+# Poppler's native extractor is used when installed; PyMuPDF is the fallback.
+PDFTOTEXT_PATH = shutil.which("pdftotext")
 
 STYLE_ENTRIES = [
     {
@@ -23,21 +37,37 @@ STYLE_ENTRIES = [
         "style_name": "KS1 style",
         "guide": "KS1 style.pdf",
         "image": "ks1 image (1).png",
+        "mime": "image/png",
     },
     {
         "style_id": "ks2",
         "style_name": "KS2 style",
         "guide": "KS2 style.pdf",
         "image": "ks2.png",
+        "mime": "image/png",
     },
     {
         "style_id": "phonics",
         "style_name": "Phonics style",
         "guide": "Phonics style.pdf",
         "image": "phonics_downscaled.png",
+        "mime": "image/png",
     },
 ]
 
+UPSERT_STYLE_SQL = """
+    INSERT INTO styles
+        (style_id, style_name, rules_text, reference_image, reference_mime, style_profile)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT (style_id)
+    DO UPDATE SET
+        style_name = EXCLUDED.style_name,
+        rules_text = EXCLUDED.rules_text,
+        reference_image = EXCLUDED.reference_image,
+        reference_mime = EXCLUDED.reference_mime,
+        style_profile = EXCLUDED.style_profile
+"""
+
 MIME_BY_SUFFIX = {
     ".png": "image/png",
     ".jpg": "image/jpeg",
@@ -48,54 +78,177 @@ MIME_BY_SUFFIX = {
 
 
 def _extract_pdf_text(path: Path) -> str:
-    reader = PdfReader(str(path))
-    parts: list[str] = []
-    for page in reader.pages:
-        text = page.extract_text() or ""
-        text = " ".join(text.split())
+    if PDFTOTEXT_PATH:
+        try:
+            return _extract_pdf_text_poppler(path)
+        except (OSError, subprocess.CalledProcessError) as exc:
+            print(f"pdftotext failed for {path}, using PyMuPDF: {exc}", file=sys.stderr)
+
+    import fitz
+
+    with fitz.open(str(path)) as doc:
+        return _join_pages(page.get_text("text") for page in doc)
+
+
+def _extract_pdf_text_poppler(path: Path) -> str:
+    completed = subprocess.run(
+        [PDFTOTEXT_PATH, "-enc", "UTF-8", str(path), "-"],
+        capture_output=True,
+        check=True,
+    )
+    # Pages are separated by form feeds; normalize each like the PyMuPDF path.
+    return _join_pages(completed.stdout.decode("utf-8", "ignore").split("\f"))
+
+
+def _join_pages(pages: Iterable[str]) -> str:
+    # Pages are whitespace-normalized and written straight into one buffer as they arrive.
+    buffer = io.StringIO()
+    for page in pages:
+        text = " ".join(page.split())
         if text:
-            parts.append(text)
-    return "\n".join(parts)
+            if buffer.tell():
+                buffer.write("\n")
+            buffer.write(text)
+    return buffer.getvalue()
+
+
+_OPEN_EVENTS = frozenset({"start_map", "start_array"})
+_CLOSE_EVENTS = frozenset({"end_map", "end_array"})
+
+
+def _is_dropped_key(key: object) -> bool:
+    return isinstance(key, str) and "cheek" in key.casefold()
+
+
+def _decode_profile_stream(payload: bytes) -> object:
+    """Builds the first JSON value in payload, skipping dropped keys' subtrees unbuilt."""
+    builder = ijson.ObjectBuilder()
+    depth = 0
+    skip_depth = 0
+    dropping = False
+    for event, value in ijson.basic_parse(io.BytesIO(payload), use_float=True):
+        if dropping:
+            dropping = False
+            if event in _OPEN_EVENTS:
+                skip_depth = 1
+            continue
+        if skip_depth:
+            if event in _OPEN_EVENTS:
+                skip_depth += 1
+            elif event in _CLOSE_EVENTS:
+                skip_depth -= 1
+            continue
+        if event == "map_key" and _is_dropped_key(value):
+            dropping = True
+            continue
+        builder.event(event, value)
+        if event in _OPEN_EVENTS:
+            depth += 1
+        elif event in _CLOSE_EVENTS:
+            depth -= 1
+            if depth == 0:
+                # Stop at the end of the first value; trailing guide text is never parsed.
+                return builder.value
+    raise ValueError("Incomplete JSON value.")
+
+
+def _extract_profile(text: str) -> object | None:
+    """Returns the embedded style profile with cheek-related keys removed."""
+    if ijson is None:
+        return _strip_profile_keys(_extract_pdf_json(text))
+
+    for idx in _json_candidates(text):
+        try:
+            return _decode_profile_stream(text[idx:].encode("utf-8"))
+        except (ijson.JSONError, ValueError):
+            continue
+    return None
+
+
+def _json_candidates(text: str):
+    # Jump between candidate openers with str.find instead of testing every character.
+    next_brace = text.find("{")
+    next_bracket = text.find("[")
+    while next_brace != -1 or next_bracket != -1:
+        if next_bracket == -1 or (next_brace != -1 and next_brace < next_bracket):
+            idx = next_brace
+            next_brace = text.find("{", idx + 1)
+        else:
+            idx = next_bracket
+            next_bracket = text.find("[", idx + 1)
+        yield idx
 
 
 def _extract_pdf_json(text: str) -> object | None:
     decoder = json.JSONDecoder()
-    idx = 0
-    length = len(text)
-    while idx < length:
-        if text[idx] not in "{[":
-            idx += 1
-            continue
+    for idx in _json_candidates(text):
         try:
-            obj, end = decoder.raw_decode(text, idx)
-        except Exception:
-            idx += 1
+            obj, _ = decoder.raw_decode(text, idx)
+        except ValueError:
             continue
         return obj
     return None
 
 
+def _has_dropped_keys(profile: object) -> bool:
+    stack = deque([profile])
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if _is_dropped_key(key):
+                    return True
+                if isinstance(value, (dict, list)):
+                    stack.append(value)
+        elif isinstance(node, list):
+            stack.extend(item for item in node if isinstance(item, (dict, list)))
+    return False
+
+
 def _strip_profile_keys(profile: object | None) -> object | None:
-    if profile is None:
-        return None
-    if isinstance(profile, dict):
-        cleaned: dict = {}
-        for key, value in profile.items():
-            if isinstance(key, str) and "cheek" in key.lower():
-                continue
-            cleaned[key] = _strip_profile_keys(value)
-        return cleaned
-    if isinstance(profile, list):
-        return [_strip_profile_keys(item) for item in profile]
-    return profile
+    # Most profiles have nothing to drop, so only rebuild when a match exists.
+    if profile is None or not _has_dropped_keys(profile):
+        return profile
+
+    root: list = [None]
+    stack: deque[tuple[object, dict | list, object]] = deque([(profile, root, 0)])
+    while stack:
+        node, parent, slot = stack.pop()
+        if isinstance(node, dict):
+            cleaned: dict = {}
+            parent[slot] = cleaned
+            for key, value in node.items():
+                if _is_dropped_key(key):
+                    continue
+                # Reserve the key now so the rebuilt dict keeps the original order.
+                cleaned[key] = None
+                stack.append((value, cleaned, key))
+        elif isinstance(node, list):
+            items: list = [None] * len(node)
+            parent[slot] = items
+            stack.extend((item, items, index) for index, item in enumerate(node))
+        else:
+            parent[slot] = node
+    return root[0]
 
 
 def _ensure_database(db_url: str) -> None:
+    import psycopg
+    from psycopg import conninfo
+
     info = conninfo.conninfo_to_dict(db_url)
     dbname = info.get("dbname")
     if not dbname:
         raise RuntimeError("DATABASE_URL missing dbname.")
 
+    # The target usually exists, so only fall back to the maintenance DB when it does not.
+    try:
+        psycopg.connect(db_url, connect_timeout=CONNECT_TIMEOUT).close()
+        return
+    except psycopg.OperationalError as exc:
+        if getattr(exc.diag, "sqlstate", None) != "3D000":
+            raise
+
     maintenance = dict(info)
     maintenance["dbname"] = "postgres"
 
@@ -113,134 +266,113 @@ def _ensure_database(db_url: str) -> None:
             conn.execute(f'CREATE DATABASE "{dbname}"')
 
 
-def _ensure_schema(conn: psycopg.Connection) -> None:
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS image_assets (
-            id UUID PRIMARY KEY,
-            session_id TEXT NOT NULL,
-            role TEXT NOT NULL,
-            filename TEXT,
-            content_type TEXT NOT NULL,
-            image_bytes BYTEA NOT NULL,
-            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-            last_accessed TIMESTAMPTZ,
-            deleted_at TIMESTAMPTZ,
-            pinned BOOLEAN NOT NULL DEFAULT FALSE
-        )
-        """
-    )
-    conn.execute(
-        """
-        CREATE INDEX IF NOT EXISTS image_assets_session_idx
-        ON image_assets (session_id)
-        """
-    )
-    conn.execute("ALTER TABLE image_assets ADD COLUMN IF NOT EXISTS last_accessed TIMESTAMPTZ")
-    conn.execute("ALTER TABLE image_assets ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ")
-    conn.execute(
-        "ALTER TABLE image_assets ADD COLUMN IF NOT EXISTS pinned BOOLEAN NOT NULL DEFAULT FALSE"
-    )
-    conn.execute(
-        """
-        CREATE INDEX IF NOT EXISTS image_assets_cleanup_idx
-        ON image_assets (deleted_at, role, created_at)
-        """
-    )
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS generation_history (
-            id UUID PRIMARY KEY,
-            session_id TEXT NOT NULL,
-            result_id UUID NOT NULL,
-            original_url TEXT,
-            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-        )
-        """
-    )
-    conn.execute(
-        """
-        CREATE INDEX IF NOT EXISTS generation_history_session_idx
-        ON generation_history (session_id, created_at)
-        """
+def _load_guide(guide_path: Path) -> tuple[str, str | None]:
+    # Parsed guides are cached by content hash and extractor, so unchanged PDFs are not re-read.
+    extractor = "pdftotext" if PDFTOTEXT_PATH else "pymupdf"
+    digest = hashlib.sha256(guide_path.read_bytes()).hexdigest()
+    cache_path = STYLE_GUIDE_CACHE_DIR / f"{digest}-{extractor}.json"
+    try:
+        cached = json.loads(cache_path.read_text(encoding="utf-8"))
+        return cached["rules_text"], cached["style_profile"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    rules_text = _extract_pdf_text(guide_path)
+    style_profile = _extract_profile(rules_text)
+    style_profile_json = (
+        json.dumps(style_profile, ensure_ascii=False, separators=(",", ":"))
+        if style_profile is not None
+        else None
     )
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS styles (
-            style_id TEXT PRIMARY KEY,
-            style_name TEXT NOT NULL,
-            rules_text TEXT NOT NULL,
-            reference_image BYTEA NOT NULL,
-            reference_mime TEXT NOT NULL,
-            style_profile TEXT
+    try:
+        STYLE_GUIDE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(
+            json.dumps({"rules_text": rules_text, "style_profile": style_profile_json}),
+            encoding="utf-8",
         )
-        """
-    )
-    conn.execute("ALTER TABLE styles ADD COLUMN IF NOT EXISTS style_profile TEXT")
+    except OSError as exc:
+        print(f"Could not cache parsed guide {guide_path}: {exc}", file=sys.stderr)
+    return rules_text, style_profile_json
 
 
-def _load_style_entry(entry: dict) -> tuple[str, str, str, bytes, str, str | None]:
+def _load_style_entry(entry: dict) -> tuple[str, str, str, Path, str, str | None]:
     guide_path = STYLE_GUIDES_DIR / entry["guide"]
     image_path = STYLE_IMAGES_DIR / entry["image"]
 
-    # Style rules come from PDFs; reference images are stored as bytes.
+    # Style rules come from PDFs; reference image bytes are mapped later by the writer.
     if not guide_path.is_file():
         raise FileNotFoundError(f"Missing guide: {guide_path}")
     if not image_path.is_file():
         raise FileNotFoundError(f"Missing image: {image_path}")
 
-    rules_text = _extract_pdf_text(guide_path)
-    style_profile = _strip_profile_keys(_extract_pdf_json(rules_text))
-    style_profile_json = (
-        json.dumps(style_profile, ensure_ascii=True) if style_profile is not None else None
-    )
-    image_bytes = image_path.read_bytes()
-    suffix = image_path.suffix.lower()
-    mime = MIME_BY_SUFFIX.get(suffix, "application/octet-stream")
-    if mime == "application/octet-stream":
+    if image_path.stat().st_size == 0:
+        raise ValueError(f"Empty image: {image_path}")
+
+    rules_text, style_profile_json = _load_guide(guide_path)
+    # Seeded entries carry their MIME type; the suffix map covers ad-hoc additions.
+    mime = entry.get("mime") or MIME_BY_SUFFIX.get(image_path.suffix.lower())
+    if mime is None:
         raise ValueError(f"Unsupported image type for {image_path}")
 
     return (
         entry["style_id"],
         entry["style_name"],
         rules_text,
-        image_bytes,
+        image_path,
         mime,
         style_profile_json,
     )
 
 
+def _map_file(stack: ExitStack, path: Path) -> memoryview:
+    with path.open("rb") as handle:
+        mapped = stack.enter_context(mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ))
+    # Registered after the map, so the view is released before the map closes.
+    return stack.enter_context(memoryview(mapped))
+
+
 def main() -> int:
+    from dotenv import load_dotenv
+
     load_dotenv()
     db_url = os.getenv("DATABASE_URL", "").strip()
     if not db_url:
         print("DATABASE_URL is not set.", file=sys.stderr)
         return 1
 
+    import psycopg
+
     _ensure_database(db_url)
 
-    with psycopg.connect(db_url, connect_timeout=CONNECT_TIMEOUT) as conn:
-        _ensure_schema(conn)
-        conn.execute("DELETE FROM styles")
-        for entry in STYLE_ENTRIES:
-            style_id, style_name, rules_text, image_bytes, mime, style_profile = (
-                _load_style_entry(entry)
-            )
-            conn.execute(
-                """
-                INSERT INTO styles
-                    (style_id, style_name, rules_text, reference_image, reference_mime, style_profile)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (style_id)
-                DO UPDATE SET
-                    style_name = EXCLUDED.style_name,
-                    rules_text = EXCLUDED.rules_text,
-                    reference_image = EXCLUDED.reference_image,
-                    reference_mime = EXCLUDED.reference_mime,
-                    style_profile = EXCLUDED.style_profile
-                """,
-                (style_id, style_name, rules_text, image_bytes, mime, style_profile),
+    # Guide parsing is CPU-bound and independent per style, so it runs in parallel.
+    workers = min(len(STYLE_ENTRIES), os.cpu_count() or 2)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(_load_style_entry, STYLE_ENTRIES))
+
+    with (
+        psycopg.connect(db_url, connect_timeout=CONNECT_TIMEOUT) as conn,
+        ExitStack() as mappings,
+    ):
+        ensure_schema(conn)
+        # Reference images are bound as read-only mmap views instead of copied into bytes.
+        params = [
+            (style_id, style_name, rules_text, _map_file(mappings, image_path), mime, profile)
+            for style_id, style_name, rules_text, image_path, mime, profile in rows
+        ]
+        # Prepare the upsert on first use rather than after the default five executions.
+        conn.prepare_threshold = 0
+        with conn.cursor() as cur:
+            # Upsert in one batch, then prune only styles no longer listed.
+            cur.executemany(UPSERT_STYLE_SQL, params)
+            cur.execute(
+                "DELETE FROM styles WHERE style_id <> ALL(%s)",
+                ([row[0] for row in rows],),
             )
+        conn.commit()
+        # Refresh the visibility map so the catalog listing stays an index-only scan.
+        conn.prepare_threshold = None
+        conn.autocommit = True
+        conn.execute("VACUUM (ANALYZE) styles")
 
     print("Database initialized and styles loaded.")
     return 0
@@ -0,0 +1,37 @@
+"""Quantizes a rembg ONNX model to int8 weights for faster CPU inference."""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "source",
+        nargs="?",
+        default=str(Path(os.getenv("U2NET_HOME", Path.home() / ".u2net")) / "u2net.onnx"),
+        help="FP32 ONNX model to quantize (defaults to rembg's cached u2net.onnx).",
+    )
+    parser.add_argument("target", nargs="?", help="Output path (defaults to <source>.int8.onnx).")
+    args = parser.parse_args()
+
+    source = Path(args.source)
+    if not source.is_file():
+        print(f"Model not found: {source}", file=sys.stderr)
+        return 1
+    target = Path(args.target) if args.target else source.with_suffix(".int8.onnx")
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(str(source), str(target), weight_type=QuantType.QUInt8)
+    print(f"Wrote {target}; set BACKGROUND_REMOVAL_MODEL=u2net_custom and")
+    print(f"BACKGROUND_REMOVAL_MODEL_PATH={target} to use it.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
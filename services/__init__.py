@@ -16,6 +16,8 @@ class AppServices:
     assets: ImageAssetStore
     pipeline: ImagePipeline
     background_removal: BackgroundRemovalService
+    # Remover for the opposite of the configured FAST_MODE, loaded on first use.
+    background_removal_alt: BackgroundRemovalService
     styles: PostgresStyleCatalog
     history: GenerationHistoryStore
 
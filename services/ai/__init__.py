@@ -2,13 +2,35 @@
 
 from __future__ import annotations
 
-from typing import Optional
+import threading
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Mapping, Optional
 
-from .base import ImageEditor
 from .nano_banana import NanoBananaEditor
 
+if TYPE_CHECKING:
+    from .base import ImageEditor
 
-def build_image_editor(config: dict) -> Optional[ImageEditor]:
+
+MODEL_LABELS: Mapping[str, str] = MappingProxyType(
+    {
+        "gemini-3-pro-image-preview": "Gemini 3 Pro Image Preview",
+        "gemini-2.5-flash-image": "Gemini 2.5 Flash Image",
+    }
+)
+
+
+@lru_cache(maxsize=8)
+def describe_editor(provider: str, model_name: str) -> tuple[str, str]:
+    """Returns the (display label, filename suffix) for a provider and model."""
+    if provider.lower() == "nano_banana":
+        return f"Nano Banana ({MODEL_LABELS.get(model_name, model_name)})", "nano"
+    return "AI", "ai"
+
+
+def build_image_editor(config: Mapping[str, object]) -> Optional[ImageEditor]:
     provider = str(config.get("IMAGE_PROVIDER", "")).lower()
     if provider == "nano_banana":
         fast_mode = bool(config.get("FAST_MODE"))
@@ -28,10 +50,67 @@ def build_image_editor(config: dict) -> Optional[ImageEditor]:
             circuit_breaker_cooldown_seconds=float(
                 config.get("GEMINI_CB_COOLDOWN_SECONDS", 60)
             ),
+            payload_format=str(config.get("GEMINI_PAYLOAD_FORMAT", "jpeg")),
         )
         return editor if editor.available else None
 
     return None
 
 
-__all__ = ["ImageEditor", "build_image_editor", "NanoBananaEditor"]
+class LazyImageEditor:
+    """Defers building the provider client until the editor is first used."""
+
+    def __init__(self, config: Mapping[str, object]) -> None:
+        self._config = dict(config)
+        self._editor: Optional[ImageEditor] = None
+        self._built = False
+        self._lock = threading.Lock()
+
+    def _resolve(self) -> Optional[ImageEditor]:
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self._editor = build_image_editor(self._config)
+                    self._built = True
+        return self._editor
+
+    @property
+    def available(self) -> bool:
+        editor = self._resolve()
+        return bool(editor and editor.available)
+
+    def edit_image(
+        self,
+        image_path: Path | bytes,
+        prompt: str,
+        style_rules: str | None = None,
+        style_reference_bytes: bytes | None = None,
+    ) -> Optional[bytes]:
+        editor = self._resolve()
+        if editor is None:
+            return None
+        return editor.edit_image(
+            image_path,
+            prompt,
+            style_rules=style_rules,
+            style_reference_bytes=style_reference_bytes,
+        )
+
+
+def __getattr__(name: str):
+    # The protocol is only needed by type checkers, so it is imported on demand.
+    if name == "ImageEditor":
+        from .base import ImageEditor
+
+        return ImageEditor
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = [
+    "ImageEditor",
+    "LazyImageEditor",
+    "MODEL_LABELS",
+    "NanoBananaEditor",
+    "build_image_editor",
+    "describe_editor",
+]
@@ -13,7 +13,7 @@ class ImageEditor(Protocol):
 
     def edit_image(
         self,
-        image_path: Path,
+        image_path: Path | bytes,
         prompt: str,
         style_rules: str | None = None,
         style_reference_bytes: bytes | None = None,
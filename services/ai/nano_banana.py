@@ -3,16 +3,21 @@
 from __future__ import annotations
 
 import base64
+import hashlib
 import io
 import logging
 import random
+import re
+import string
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from pathlib import Path
 from typing import Optional
 
-from PIL import Image, ImageFilter
+import numpy as np
+from PIL import Image
 
+from ..offload import run_cpu_bound
 from ..timing import log_timing
 
 genai_client = None
@@ -33,6 +38,21 @@ except Exception:
 
 logger = logging.getLogger(__name__)
 
+# Request images are style/layout hints, so lossy JPEG is used unless PNG is configured.
+PAYLOAD_JPEG_QUALITY = 90
+PAYLOAD_JPEG_QUALITY_FAST = 85
+# Layout hints are percentages of the canvas, so bounds are found on a small copy.
+LAYOUT_ANALYSIS_MAX_SIZE = 512
+LAYOUT_CACHE_MAX_ENTRIES = 256
+STYLE_REFERENCE_CACHE_MAX_ENTRIES = 64
+
+_RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+# Substring match (no word boundaries) so names like ReadTimeout still count.
+_RETRYABLE_MESSAGE_RE = re.compile(
+    r"429|50[234]|resource_exhausted|rate limit|quota|unavailable|overloaded|timeout|timed out|deadline",
+    re.IGNORECASE,
+)
+
 # Prompt template enforces style, layout, and content constraints for the model.
 SYSTEM_PROMPT_TEMPLATE = """You are the Illustration Variant Generator (IVG), an image-to-image variation engine. Your task is to generate a new illustration that preserves the exact visual style of the provided reference image(s) and the style rules, while applying the user's requested change(s). The style rules come from a PDF guide and are authoritative for *style construction* (brush, linework, palette, shading, CMYK feel). The output must look like it belongs to the same illustration set: line weight, color treatment, shading, proportions, and overall rendering must match precisely.
 
@@ -88,6 +108,17 @@ USER REQUEST:
 {user_prompt}
 """
 
+# The template is split into literal segments once; each request only joins the pieces.
+_PROMPT_SEGMENTS = tuple(
+    (literal, field) for literal, field, _, _ in string.Formatter().parse(SYSTEM_PROMPT_TEMPLATE)
+)
+
+
+def _render_prompt(**values: str) -> str:
+    return "".join(
+        literal + values[field] if field else literal for literal, field in _PROMPT_SEGMENTS
+    )
+
 
 class NanoBananaError(RuntimeError):
     pass
@@ -97,35 +128,66 @@ class NanoBananaRetryableError(NanoBananaError):
     pass
 
 
+_BREAKER_CLOSED = "closed"
+_BREAKER_OPEN = "open"
+_BREAKER_HALF_OPEN = "half_open"
+
+
 class _CircuitBreaker:
-    """Simple circuit breaker to stop hammering the provider during outages."""
+    """Circuit breaker that stops hammering the provider during outages.
+
+    After the cooldown a single probe call is admitted (half-open); only its
+    success closes the breaker, and its failure re-opens it for another cooldown.
+    """
     def __init__(self, threshold: int, cooldown_seconds: float) -> None:
         self._threshold = max(0, int(threshold))
         self._cooldown = max(0.0, float(cooldown_seconds))
+        self._state = _BREAKER_CLOSED
         self._failures = 0
         self._opened_at = 0.0
+        self._probe_in_flight = False
+        # Provider calls finish on several threads; state transitions happen under the lock.
+        self._lock = threading.Lock()
 
     def allow(self) -> bool:
         if not self._threshold or not self._cooldown:
             return True
-        if self._opened_at == 0.0:
+        # Lock-free fast path while closed; a stale read here only delays tripping by one call.
+        if self._state == _BREAKER_CLOSED:
             return True
-        if time.monotonic() - self._opened_at >= self._cooldown:
-            self._opened_at = 0.0
-            self._failures = 0
+        with self._lock:
+            if self._state == _BREAKER_CLOSED:
+                return True
+            if self._state == _BREAKER_OPEN:
+                if time.monotonic() - self._opened_at < self._cooldown:
+                    return False
+                self._state = _BREAKER_HALF_OPEN
+                self._probe_in_flight = False
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
             return True
-        return False
 
     def record_success(self) -> None:
-        self._failures = 0
-        self._opened_at = 0.0
+        if self._state == _BREAKER_CLOSED and self._failures == 0:
+            return
+        with self._lock:
+            self._state = _BREAKER_CLOSED
+            self._failures = 0
+            self._opened_at = 0.0
+            self._probe_in_flight = False
 
     def record_failure(self) -> None:
         if not self._threshold:
             return
-        self._failures += 1
-        if self._failures >= self._threshold and self._cooldown:
-            self._opened_at = time.monotonic()
+        with self._lock:
+            self._failures += 1
+            if self._state == _BREAKER_HALF_OPEN or (
+                self._failures >= self._threshold and self._cooldown
+            ):
+                self._state = _BREAKER_OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
 
 
 class NanoBananaEditor:
@@ -142,6 +204,7 @@ class NanoBananaEditor:
         backoff_max_seconds: float = 8.0,
         circuit_breaker_threshold: int = 5,
         circuit_breaker_cooldown_seconds: float = 60.0,
+        payload_format: str = "jpeg",
     ) -> None:
         self._client = None
         self._model = None
@@ -153,6 +216,7 @@ class NanoBananaEditor:
         self._max_retries = max(0, int(max_retries))
         self._backoff_base = max(0.0, float(backoff_base_seconds))
         self._backoff_max = max(0.0, float(backoff_max_seconds))
+        self._payload_png = payload_format.lower() == "png"
         self._breaker = _CircuitBreaker(circuit_breaker_threshold, circuit_breaker_cooldown_seconds)
         self.available = bool(enabled) and bool(api_key) and genai_client is not None
         if not self.available:
@@ -165,7 +229,13 @@ class NanoBananaEditor:
 
         try:
             if self._backend == "genai":
-                self._client = genai_client.Client(api_key=api_key)
+                # The HTTP client enforces the timeout, so it only covers time on the wire.
+                http_options = None
+                if self._timeout_seconds > 0:
+                    http_options = genai_types.HttpOptions(
+                        timeout=int(self._timeout_seconds * 1000)
+                    )
+                self._client = genai_client.Client(api_key=api_key, http_options=http_options)
             else:
                 genai_client.configure(api_key=api_key)
                 self._model = genai_client.GenerativeModel(model_name)
@@ -176,7 +246,7 @@ class NanoBananaEditor:
 
     def edit_image(
         self,
-        image_path: Path,
+        image_path: Path | bytes,
         prompt: str,
         style_rules: str | None = None,
         style_reference_bytes: bytes | None = None,
@@ -191,97 +261,37 @@ class NanoBananaEditor:
                 raise NanoBananaRetryableError("AI model not ready; please retry.")
 
         try:
-            pil_img = Image.open(image_path).convert("RGB")
-            layout_hint = _describe_layout(pil_img)
-            combined_prompt = SYSTEM_PROMPT_TEMPLATE.format(
-                style_rules=style_rules.strip() if style_rules else "None provided.",
-                layout_hint=layout_hint or "None provided.",
-                user_prompt=prompt.strip(),
+            # Decoding, layout analysis and payload encoding would stall a gevent hub.
+            contents = run_cpu_bound(
+                self._build_contents, image_path, prompt, style_rules, style_reference_bytes
             )
             if self._backend == "genai":
-                contents = [genai_types.Part.from_text(text=combined_prompt)]
-                if style_reference_bytes:
-                    try:
-                        style_img = Image.open(io.BytesIO(style_reference_bytes)).convert("RGB")
-                        if self._fast_mode:
-                            style_img = _downscale_image(style_img, self._reference_max_size)
-                        # Style reference is provided as style-only guidance, not content.
-                        contents.append(
-                            genai_types.Part.from_text(
-                                text="STYLE REFERENCE IMAGE (style only; do not copy content or composition)"
-                            )
-                        )
-                        contents.append(
-                            genai_types.Part.from_bytes(
-                                data=_image_to_png_bytes(style_img), mime_type="image/png"
-                            )
-                        )
-                    except Exception as exc:
-                        logger.warning("[NanoBanana] style reference decode failed: %s", exc)
-                contents.append(
-                    genai_types.Part.from_text(
-                        text="SOURCE IMAGE (ground-truth content/composition; preserve unless user requests changes)"
-                    )
-                )
-                contents.append(
-                    genai_types.Part.from_bytes(
-                        data=_image_to_png_bytes(pil_img), mime_type="image/png"
-                    )
-                )
-                if not self._fast_mode:
-                    # Repeat the source image to reinforce layout preservation.
-                    contents.append(
-                        genai_types.Part.from_text(
-                            text="SOURCE IMAGE (repeat for emphasis; do not change layout, scale, or framing)"
-                        )
-                    )
-                    contents.append(
-                        genai_types.Part.from_bytes(
-                            data=_image_to_png_bytes(pil_img), mime_type="image/png"
-                        )
-                    )
+
                 def _call_genai():
                     return self._client.models.generate_content(
                         model=self._model_name, contents=contents
                     )
 
-                with log_timing(f"nanobanana generate_content {self._model_name}", logger):
-                    response = self._generate_with_retries(_call_genai)
+                call_fn = _call_genai
             else:
-                contents = [combined_prompt]
-                if style_reference_bytes:
-                    try:
-                        style_img = Image.open(io.BytesIO(style_reference_bytes)).convert("RGB")
-                        if self._fast_mode:
-                            style_img = _downscale_image(style_img, self._reference_max_size)
-                        contents.append(
-                            "STYLE REFERENCE IMAGE (style only; do not copy content or composition)"
-                        )
-                        contents.append(style_img)
-                    except Exception as exc:
-                        logger.warning("[NanoBanana] style reference decode failed: %s", exc)
-                contents.append(
-                    "SOURCE IMAGE (ground-truth content/composition; preserve unless user requests changes)"
+                request_options = (
+                    {"timeout": self._timeout_seconds} if self._timeout_seconds > 0 else None
                 )
-                contents.append(pil_img)
-                if not self._fast_mode:
-                    contents.append(
-                        "SOURCE IMAGE (repeat for emphasis; do not change layout, scale, or framing)"
-                    )
-                    contents.append(pil_img)
+
                 def _call_generativeai():
-                    return self._model.generate_content(contents, stream=False)
+                    return self._model.generate_content(
+                        contents, stream=False, request_options=request_options
+                    )
 
-                with log_timing(f"nanobanana generate_content {self._model_name}", logger):
-                    response = self._generate_with_retries(_call_generativeai)
+                call_fn = _call_generativeai
 
-            for candidate in response.candidates or []:
-                for part in candidate.content.parts or []:
-                    inline = getattr(part, "inline_data", None)
-                    image_bytes = _inline_image_to_png(inline)
-                    if image_bytes:
-                        logger.info("[NanoBanana] image generated")
-                        return image_bytes
+            with log_timing(f"nanobanana generate_content {self._model_name}", logger):
+                response = self._generate_with_retries(call_fn)
+
+            image_bytes = run_cpu_bound(_response_image, response)
+            if image_bytes:
+                logger.info("[NanoBanana] image generated")
+                return image_bytes
 
             try:
                 text = getattr(response, "text", "")
@@ -298,6 +308,117 @@ class NanoBananaEditor:
             logger.warning("[NanoBanana] edit error: %s", exc)
             raise NanoBananaRetryableError("AI generation failed; please retry.") from exc
 
+    def _build_contents(
+        self,
+        image_path: Path | bytes,
+        prompt: str,
+        style_rules: str | None,
+        style_reference_bytes: bytes | None,
+    ) -> list:
+        # Callers holding the asset in memory pass bytes and skip the temp-file round trip.
+        if isinstance(image_path, bytes):
+            source_bytes = image_path
+        else:
+            source_bytes = Path(image_path).read_bytes()
+        pil_img = Image.open(io.BytesIO(source_bytes)).convert("RGB")
+        layout_hint = _cached_layout_hint(source_bytes, pil_img)
+        combined_prompt = _render_prompt(
+            style_rules=style_rules.strip() if style_rules else "None provided.",
+            layout_hint=layout_hint or "None provided.",
+            user_prompt=prompt.strip(),
+        )
+        if self._backend == "genai":
+            contents = [genai_types.Part.from_text(text=combined_prompt)]
+            if style_reference_bytes:
+                try:
+                    style_part = self._style_reference_part(style_reference_bytes)
+                    # Style reference is provided as style-only guidance, not content.
+                    contents.append(
+                        genai_types.Part.from_text(
+                            text="STYLE REFERENCE IMAGE (style only; do not copy content or composition)"
+                        )
+                    )
+                    contents.append(style_part)
+                except Exception as exc:
+                    logger.warning("[NanoBanana] style reference decode failed: %s", exc)
+            contents.append(
+                genai_types.Part.from_text(
+                    text="SOURCE IMAGE (ground-truth content/composition; preserve unless user requests changes)"
+                )
+            )
+            # Encode the source once; the emphasis repeat reuses the same part.
+            source_part = self._image_part(pil_img)
+            contents.append(source_part)
+            if not self._fast_mode:
+                # Repeat the source image to reinforce layout preservation.
+                contents.append(
+                    genai_types.Part.from_text(
+                        text="SOURCE IMAGE (repeat for emphasis; do not change layout, scale, or framing)"
+                    )
+                )
+                contents.append(source_part)
+            return contents
+
+        contents = [combined_prompt]
+        if style_reference_bytes:
+            try:
+                style_img = self._style_reference_image(
+                    self._style_reference_key(style_reference_bytes),
+                    style_reference_bytes,
+                )
+                contents.append(
+                    "STYLE REFERENCE IMAGE (style only; do not copy content or composition)"
+                )
+                contents.append(style_img)
+            except Exception as exc:
+                logger.warning("[NanoBanana] style reference decode failed: %s", exc)
+        contents.append(
+            "SOURCE IMAGE (ground-truth content/composition; preserve unless user requests changes)"
+        )
+        contents.append(pil_img)
+        if not self._fast_mode:
+            contents.append(
+                "SOURCE IMAGE (repeat for emphasis; do not change layout, scale, or framing)"
+            )
+            contents.append(pil_img)
+        return contents
+
+    def _image_part(self, img: Image.Image):
+        data, mime_type = self._encode_payload(img)
+        return genai_types.Part.from_bytes(data=data, mime_type=mime_type)
+
+    def _encode_payload(self, img: Image.Image) -> tuple[bytes, str]:
+        if self._payload_png:
+            return _image_to_png_bytes(img), "image/png"
+        quality = PAYLOAD_JPEG_QUALITY_FAST if self._fast_mode else PAYLOAD_JPEG_QUALITY
+        return _image_to_jpeg_bytes(img, quality), "image/jpeg"
+
+    def _style_reference_key(self, style_reference_bytes: bytes) -> tuple[bytes, bool, int]:
+        digest = hashlib.blake2b(style_reference_bytes, digest_size=16).digest()
+        return digest, self._fast_mode, self._reference_max_size
+
+    def _style_reference_image(
+        self, key: tuple[bytes, bool, int], style_reference_bytes: bytes
+    ) -> Image.Image:
+        # Style references are stable per style, so decode + downscale runs once per blob.
+        img = _STYLE_IMAGE_CACHE.get(key)
+        if img is None:
+            img = Image.open(io.BytesIO(style_reference_bytes)).convert("RGB")
+            if self._fast_mode:
+                img = _downscale_image(img, self._reference_max_size)
+            _remember(_STYLE_IMAGE_CACHE, key, img, STYLE_REFERENCE_CACHE_MAX_ENTRIES)
+        return img
+
+    def _style_reference_part(self, style_reference_bytes: bytes):
+        key = self._style_reference_key(style_reference_bytes)
+        payload_key = (*key, self._payload_png)
+        payload = _STYLE_PAYLOAD_CACHE.get(payload_key)
+        if payload is None:
+            payload = self._encode_payload(self._style_reference_image(key, style_reference_bytes))
+            _remember(_STYLE_PAYLOAD_CACHE, payload_key, payload, STYLE_REFERENCE_CACHE_MAX_ENTRIES)
+        data, mime_type = payload
+        return genai_types.Part.from_bytes(data=data, mime_type=mime_type)
+
     def _generate_with_retries(self, call_fn):
         # Retry transient provider failures with backoff and circuit breaker protection.
         if not self._breaker.allow():
@@ -306,7 +427,7 @@ class NanoBananaEditor:
         retries = 0
         while True:
             try:
-                response = _call_with_timeout(call_fn, self._timeout_seconds)
+                response = call_fn()
                 self._breaker.record_success()
                 return response
             except Exception as exc:
@@ -316,6 +437,11 @@ class NanoBananaEditor:
                     raise NanoBananaError("AI request failed.") from exc
                 if retries >= self._max_retries:
                     raise NanoBananaRetryableError("AI generation failed; please retry.") from exc
+                if not self._breaker.allow():
+                    # The breaker opened mid-loop; leave recovery to the half-open probe.
+                    raise NanoBananaRetryableError(
+                        "AI temporarily unavailable; please retry."
+                    ) from exc
                 delay = _compute_backoff(self._backoff_base, self._backoff_max, retries)
                 retries += 1
                 logger.warning(
@@ -328,6 +454,18 @@ class NanoBananaEditor:
                 time.sleep(delay)
 
 
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _response_image(response) -> Optional[bytes]:
+    for candidate in response.candidates or []:
+        for part in candidate.content.parts or []:
+            image_bytes = _inline_image_to_png(getattr(part, "inline_data", None))
+            if image_bytes:
+                return image_bytes
+    return None
+
+
 def _inline_image_to_png(inline: object) -> Optional[bytes]:
     if not inline:
         return None
@@ -349,9 +487,12 @@ def _inline_image_to_png(inline: object) -> Optional[bytes]:
             data = base64.b64decode(data)
         except Exception:
             return None
+    elif not isinstance(data, bytes):
+        data = bytes(data)
 
-    if mime_type == "image/png":
-        return data if isinstance(data, (bytes, bytearray)) else None
+    # PNG payloads (including mislabelled ones) are passed through without re-encoding.
+    if mime_type == "image/png" or data.startswith(_PNG_SIGNATURE):
+        return data
 
     try:
         img = Image.open(io.BytesIO(data))
@@ -371,21 +512,59 @@ def _image_to_png_bytes(img: Image.Image) -> bytes:
     return buffer.getvalue()
 
 
+def _image_to_jpeg_bytes(img: Image.Image, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=quality, optimize=False, progressive=False)
+    return buffer.getvalue()
+
+
 def _downscale_image(img: Image.Image, max_size: int) -> Image.Image:
     if max_size <= 0:
         return img
-    if max(img.size) <= max_size:
+    width, height = img.size
+    if max(width, height) <= max_size:
         return img
-    resized = img.copy()
-    resized.thumbnail((max_size, max_size), Image.BILINEAR)
-    return resized
+    # resize() builds the smaller image directly instead of copying the full raster first.
+    scale = max_size / max(width, height)
+    return img.resize(
+        (max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR
+    )
+
+
+# Re-edits of the same upload skip edge detection; keyed by content since temp paths differ.
+_LAYOUT_CACHE: dict[bytes, Optional[str]] = {}
+# Prepared style references, keyed by (content digest, fast mode, max size[, PNG payload]).
+_STYLE_IMAGE_CACHE: dict[tuple[bytes, bool, int], Image.Image] = {}
+_STYLE_PAYLOAD_CACHE: dict[tuple[bytes, bool, int, bool], tuple[bytes, str]] = {}
+
+
+def _remember(cache: dict, key: object, value: object, max_entries: int) -> None:
+    if len(cache) >= max_entries:
+        cache.clear()
+    cache[key] = value
+
+
+def _cached_layout_hint(image_bytes: bytes, img: Image.Image) -> Optional[str]:
+    key = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    if key in _LAYOUT_CACHE:
+        return _LAYOUT_CACHE[key]
+    hint = _describe_layout(img)
+    _remember(_LAYOUT_CACHE, key, hint, LAYOUT_CACHE_MAX_ENTRIES)
+    return hint
 
 
 def _describe_layout(img: Image.Image) -> Optional[str]:
-    width, height = img.size
-    if not width or not height:
+    if not img.width or not img.height:
         return None
 
+    scale = min(1.0, LAYOUT_ANALYSIS_MAX_SIZE / max(img.size))
+    if scale < 1.0:
+        img = img.resize(
+            (max(1, int(img.width * scale)), max(1, int(img.height * scale))),
+            Image.BILINEAR,
+        )
+    width, height = img.size
+
     bbox = _alpha_bbox(img)
     if bbox is None:
         bbox = _edge_bbox(img)
@@ -422,32 +601,32 @@ def _alpha_bbox(img: Image.Image) -> Optional[tuple[int, int, int, int]]:
 
 def _edge_bbox(img: Image.Image) -> Optional[tuple[int, int, int, int]]:
     try:
-        edges = img.convert("L").filter(ImageFilter.FIND_EDGES)
+        # Signed copy so neighbour differences do not wrap around.
+        gray = np.asarray(img.convert("L"), dtype=np.int16)
+        grad_x = np.abs(np.diff(gray, axis=1, prepend=gray[:, :1]))
+        grad_y = np.abs(np.diff(gray, axis=0, prepend=gray[:1, :]))
         # Threshold to reduce noise from low-contrast edges.
-        edges = edges.point(lambda v: 255 if v > 20 else 0)
-        return edges.getbbox()
+        mask = (grad_x + grad_y) > 20
+        rows = mask.any(axis=1)
+        cols = mask.any(axis=0)
+        if not rows.any():
+            return None
+        top = int(rows.argmax())
+        bottom = len(rows) - int(rows[::-1].argmax())
+        left = int(cols.argmax())
+        right = len(cols) - int(cols[::-1].argmax())
+        return left, top, right, bottom
     except Exception:
         return None
 
 
-def _call_with_timeout(call_fn, timeout_seconds: float):
-    # Run the provider call in a thread to enforce a hard timeout.
-    if timeout_seconds <= 0:
-        return call_fn()
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(call_fn)
-        try:
-            return future.result(timeout=timeout_seconds)
-        except FutureTimeout as exc:
-            raise TimeoutError("Gemini request timed out.") from exc
-
-
 def _compute_backoff(base: float, cap: float, attempt: int) -> float:
+    # Full jitter: spreading retries over [0, delay] keeps clients from retrying in lockstep.
     if base <= 0:
         return 0.0
-    delay = base * (2**attempt)
+    delay = base * (1 << attempt)
     delay = min(delay, cap) if cap > 0 else delay
-    return delay * random.uniform(0.75, 1.25)
+    return random.uniform(0.0, delay)
 
 
 def _is_retryable_error(exc: Exception) -> bool:
@@ -460,20 +639,7 @@ def _is_retryable_error(exc: Exception) -> bool:
             code_val = int(code)
         except Exception:
             code_val = None
-        if code_val in {429, 500, 502, 503, 504}:
+        if code_val in _RETRYABLE_STATUS_CODES:
             return True
-    message = str(exc).lower()
-    retry_tokens = [
-        "429",
-        "503",
-        "502",
-        "504",
-        "resource_exhausted",
-        "rate limit",
-        "quota",
-        "unavailable",
-        "overloaded",
-        "timeout",
-        "deadline",
-    ]
-    return any(token in message for token in retry_tokens)
+    # HTTP client timeouts (e.g. httpx.ReadTimeout) carry the hint in the class name.
+    return _RETRYABLE_MESSAGE_RE.search(f"{type(exc).__name__} {exc}") is not None
@@ -2,9 +2,13 @@
 
 from __future__ import annotations
 
+import inspect
 import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Mapping, Optional
 
 from .timing import log_timing
 
@@ -16,6 +20,24 @@ except Exception:  # pragma: no cover
 
 logger = logging.getLogger(__name__)
 
+
+def _remove_parameters() -> Optional[frozenset[str]]:
+    """Keyword names rembg.remove accepts, or None when it takes arbitrary kwargs."""
+    if remove is None:
+        return frozenset()
+    try:
+        parameters = inspect.signature(remove).parameters.values()
+    except (TypeError, ValueError):  # pragma: no cover
+        return None
+    if any(param.kind is inspect.Parameter.VAR_KEYWORD for param in parameters):
+        return None
+    return frozenset(param.name for param in parameters)
+
+
+# Probed once so older rembg releases never hit a TypeError (and a sessionless retry) per call.
+_REMOVE_PARAMETERS = _remove_parameters()
+
+
 class BackgroundRemovalService:
     def __init__(
         self,
@@ -27,33 +49,53 @@ class BackgroundRemovalService:
         alpha_matting_erode_size: int = 10,
         post_process_mask: bool = True,
         lazy_init: bool = False,
+        model_path: str | None = None,
     ) -> None:
         self._result_dir = result_dir
         self._model_name = model_name
+        # Custom sessions (e.g. u2net_custom) load a local, possibly int8-quantized, ONNX file.
+        self._session_kwargs = {"model_path": model_path} if model_path else {}
         self._lazy_init = lazy_init
-        self._alpha_matting = alpha_matting
-        self._alpha_matting_foreground_threshold = alpha_matting_foreground_threshold
-        self._alpha_matting_background_threshold = alpha_matting_background_threshold
-        self._alpha_matting_erode_size = alpha_matting_erode_size
-        self._post_process_mask = post_process_mask
+        remove_kwargs = {
+            "alpha_matting": alpha_matting,
+            "alpha_matting_foreground_threshold": alpha_matting_foreground_threshold,
+            "alpha_matting_background_threshold": alpha_matting_background_threshold,
+            "alpha_matting_erode_size": alpha_matting_erode_size,
+            "post_process_mask": post_process_mask,
+        }
+        if _REMOVE_PARAMETERS is not None:
+            remove_kwargs = {
+                key: value for key, value in remove_kwargs.items() if key in _REMOVE_PARAMETERS
+            }
+        self._remove_kwargs = remove_kwargs
         self._session = None
+        self._session_lock = threading.Lock()
         self.available = remove is not None
         if self.available and new_session is not None and not self._lazy_init:
             try:
-                self._session = new_session(model_name)
+                self._session = new_session(model_name, **self._session_kwargs)
             except Exception as exc:  # pragma: no cover
                 logger.warning("Background removal model init failed: %s", exc)
                 self._session = None
 
+    def warm(self) -> None:
+        """Loads the model session now instead of on the first removal."""
+        if self.available:
+            self._ensure_session()
+
     def _ensure_session(self) -> None:
         if self._session is not None or not self.available or new_session is None:
             return
-        try:
-            # Lazy-init the model session to avoid heavy startup cost.
-            self._session = new_session(self._model_name)
-        except Exception as exc:  # pragma: no cover
-            logger.warning("Background removal model init failed: %s", exc)
-            self._session = None
+        # Concurrent first requests must not load the model more than once.
+        with self._session_lock:
+            if self._session is not None:
+                return
+            try:
+                # Lazy-init the model session to avoid heavy startup cost.
+                self._session = new_session(self._model_name, **self._session_kwargs)
+            except Exception as exc:  # pragma: no cover
+                logger.warning("Background removal model init failed: %s", exc)
+                self._session = None
 
     def remove_background(self, image_path: Path, output_name: str | None = None) -> Optional[Path]:
         if not self.available:
@@ -84,18 +126,69 @@ class BackgroundRemovalService:
             if self._session is None and self._model_name:
                 raise RuntimeError("Background removal model unavailable.")
             with log_timing("background removal", logger):
-                return remove(
-                    image_bytes,
-                    session=self._session,
-                    alpha_matting=self._alpha_matting,
-                    alpha_matting_foreground_threshold=self._alpha_matting_foreground_threshold,
-                    alpha_matting_background_threshold=self._alpha_matting_background_threshold,
-                    alpha_matting_erode_size=self._alpha_matting_erode_size,
-                    post_process_mask=self._post_process_mask,
-                )
-        except TypeError:
-            with log_timing("background removal fallback", logger):
-                return remove(image_bytes)
+                return remove(image_bytes, session=self._session, **self._remove_kwargs)
         except Exception as exc:
             logger.warning("Background removal failed: %s", exc)
             return None
+
+
+def build_background_removal(
+    config: Mapping[str, object], result_dir: Path, fast_mode: bool, lazy_init: bool = False
+) -> BackgroundRemovalService:
+    """Builds the remover for the requested mode from uppercase config values."""
+    background_model = config.get("BACKGROUND_REMOVAL_MODEL", "u2net")
+    model_path = config.get("BACKGROUND_REMOVAL_MODEL_PATH", "")
+    alpha_matting = config.get("BACKGROUND_REMOVAL_ALPHA_MATTING", True)
+    post_process = config.get("BACKGROUND_REMOVAL_POST_PROCESS", True)
+    if fast_mode:
+        background_model = config.get("BACKGROUND_REMOVAL_MODEL_FAST", "birefnet-general-lite")
+        model_path = config.get("BACKGROUND_REMOVAL_MODEL_PATH_FAST", "")
+        alpha_matting = config.get("BACKGROUND_REMOVAL_FAST_ALPHA_MATTING", False)
+        post_process = config.get("BACKGROUND_REMOVAL_FAST_POST_PROCESS", False)
+    return BackgroundRemovalService(
+        result_dir,
+        model_name=str(background_model),
+        alpha_matting=bool(alpha_matting),
+        alpha_matting_foreground_threshold=int(config.get("BACKGROUND_REMOVAL_FG_THRESHOLD", 240)),
+        alpha_matting_background_threshold=int(config.get("BACKGROUND_REMOVAL_BG_THRESHOLD", 10)),
+        alpha_matting_erode_size=int(config.get("BACKGROUND_REMOVAL_ERODE_SIZE", 10)),
+        post_process_mask=bool(post_process),
+        lazy_init=lazy_init or bool(config.get("BACKGROUND_REMOVAL_LAZY_INIT", False)),
+        model_path=str(model_path) or None,
+    )
+
+
+# Per-process removers, populated by the pool initializer in each worker.
+_worker_config: dict[str, object] = {}
+_worker_result_dir: Optional[Path] = None
+_worker_removers: dict[bool, BackgroundRemovalService] = {}
+
+
+def create_removal_executor(
+    config: Mapping[str, object], result_dir: Path, fast_mode: bool, max_workers: int
+) -> ProcessPoolExecutor:
+    """Starts worker processes that preload the default-mode model for inline removal."""
+    # Spawned children avoid inheriting the server's threads and open connections.
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_removal_worker,
+        initargs=(dict(config), result_dir, fast_mode),
+    )
+
+
+def remove_background_in_worker(image_bytes: bytes, fast_mode: bool) -> Optional[bytes]:
+    remover = _worker_removers.get(fast_mode)
+    if remover is None:
+        remover = build_background_removal(
+            _worker_config, _worker_result_dir or Path("."), fast_mode, lazy_init=True
+        )
+        _worker_removers[fast_mode] = remover
+    return remover.remove_background_bytes(image_bytes)
+
+
+def _init_removal_worker(config: dict[str, object], result_dir: Path, fast_mode: bool) -> None:
+    global _worker_result_dir
+    _worker_config.update(config)
+    _worker_result_dir = result_dir
+    _worker_removers[fast_mode] = build_background_removal(config, result_dir, fast_mode)
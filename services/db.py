@@ -0,0 +1,27 @@
+"""Shared Postgres connection pool for the storage services."""
+
+from __future__ import annotations
+
+from psycopg import Connection
+from psycopg_pool import ConnectionPool
+
+DEFAULT_POOL_MIN_SIZE = 2
+DEFAULT_POOL_MAX_SIZE = 20
+# Transaction-scoped, so it is released by the commit that ends the migration.
+_SCHEMA_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtext('ivg_schema_migrate'))"
+
+
+def create_pool(
+    dsn: str,
+    min_size: int = DEFAULT_POOL_MIN_SIZE,
+    max_size: int = DEFAULT_POOL_MAX_SIZE,
+) -> ConnectionPool:
+    """Opens the per-process pool that every store shares instead of reconnecting per call."""
+    min_size = max(1, int(min_size))
+    max_size = max(min_size, int(max_size))
+    return ConnectionPool(dsn, min_size=min_size, max_size=max_size, open=True, name="ivg")
+
+
+def lock_schema(conn: Connection) -> None:
+    """Waits until this transaction holds the cross-process schema migration lock."""
+    conn.execute(_SCHEMA_LOCK_SQL)
@@ -7,15 +7,48 @@ from datetime import datetime
 from typing import Optional
 from uuid import UUID, uuid4
 
-import psycopg
+from psycopg import Connection
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 
 import logging
 
+from .db import lock_schema
 from .timing import log_timing
 
 DEFAULT_HISTORY_LIMIT = 200
 
+# Hot-path statements are prepared server-side on first use of each pooled connection.
+INSERT_HISTORY_SQL = """
+    INSERT INTO generation_history (id, session_id, result_id, original_url)
+    VALUES (%s, %s, %s, %s)
+"""
+# The DELETE runs on the statement's snapshot, which excludes the row being inserted,
+# so it keeps one fewer existing row to leave max_entries in total. The cutoff is the
+# first row past the keep window, found by walking the (session_id, created_at) index.
+INSERT_AND_TRIM_HISTORY_SQL = """
+    WITH inserted AS (
+        INSERT INTO generation_history (id, session_id, result_id, original_url)
+        VALUES (%(id)s, %(session_id)s, %(result_id)s, %(original_url)s)
+        RETURNING 1
+    )
+    DELETE FROM generation_history
+    WHERE session_id = %(session_id)s
+      AND created_at <= (
+        SELECT created_at FROM generation_history
+        WHERE session_id = %(session_id)s
+        ORDER BY created_at DESC
+        LIMIT 1 OFFSET %(keep)s
+      )
+"""
+LIST_HISTORY_SQL = """
+    SELECT id, result_id, original_url, created_at
+    FROM generation_history
+    WHERE session_id = %s
+    ORDER BY created_at ASC
+    LIMIT %s
+"""
+
 logger = logging.getLogger(__name__)
 
 
@@ -30,14 +63,16 @@ class HistoryEntry:
 class GenerationHistoryStore:
     """Stores and retrieves per-session generation history in Postgres."""
 
-    def __init__(self, dsn: str, max_entries: int = DEFAULT_HISTORY_LIMIT) -> None:
-        self._dsn = dsn
+    def __init__(self, pool: ConnectionPool, max_entries: int = DEFAULT_HISTORY_LIMIT) -> None:
+        self._pool = pool
         self._max_entries = max_entries
 
     def ensure_schema(self) -> None:
-        """Creates the generation_history table and index if they do not exist."""
+        """Creates the generation_history table and indexes if they do not exist."""
         with log_timing("db generation_history ensure_schema", logger):
-            with psycopg.connect(self._dsn) as conn:
+            with self._pool.connection() as conn:
+                # Concurrent IF NOT EXISTS DDL from several workers can still collide.
+                lock_schema(conn)
                 conn.execute(
                     """
                     CREATE TABLE IF NOT EXISTS generation_history (
@@ -55,6 +90,12 @@ class GenerationHistoryStore:
                     ON generation_history (session_id, created_at)
                     """
                 )
+                conn.execute(
+                    """
+                    CREATE INDEX IF NOT EXISTS generation_history_result_idx
+                    ON generation_history (result_id)
+                    """
+                )
 
     def add_entry(self, session_id: str, result_id: str, original_url: str | None) -> None:
         """Records one generation output and keeps the newest entries per session."""
@@ -62,44 +103,42 @@ class GenerationHistoryStore:
         if not result_uuid:
             raise ValueError("Invalid result id for history entry.")
 
-        entry_id = uuid4()
         with log_timing("db generation_history add_entry", logger):
-            with psycopg.connect(self._dsn) as conn:
-                conn.execute(
-                    """
-                    INSERT INTO generation_history (id, session_id, result_id, original_url)
-                    VALUES (%s, %s, %s, %s)
-                    """,
-                    (entry_id, session_id, result_uuid, original_url),
-                )
-                if self._max_entries > 0:
-                    conn.execute(
-                        """
-                        DELETE FROM generation_history
-                        WHERE id IN (
-                            SELECT id FROM generation_history
-                            WHERE session_id = %s
-                            ORDER BY created_at DESC
-                            OFFSET %s
-                        )
-                        """,
-                        (session_id, self._max_entries),
-                    )
+            with self._pool.connection() as conn:
+                self.add_entry_on(conn, session_id, result_uuid, original_url)
+
+    def add_entry_on(
+        self, conn: Connection, session_id: str, result_id: UUID, original_url: str | None
+    ) -> None:
+        """Records an entry on the caller's connection, inside its open transaction."""
+        entry_id = uuid4()
+        if self._max_entries > 0:
+            # Insert and prune in a single statement, so one round-trip per entry.
+            conn.execute(
+                INSERT_AND_TRIM_HISTORY_SQL,
+                {
+                    "id": entry_id,
+                    "session_id": session_id,
+                    "result_id": result_id,
+                    "original_url": original_url,
+                    "keep": self._max_entries - 1,
+                },
+                prepare=True,
+            )
+        else:
+            conn.execute(
+                INSERT_HISTORY_SQL,
+                (entry_id, session_id, result_id, original_url),
+                prepare=True,
+            )
 
     def list_entries(self, session_id: str, limit: int | None = None) -> list[HistoryEntry]:
         """Returns the most recent history entries for the given session."""
         fetch_limit = self._max_entries if limit is None else limit
         with log_timing("db generation_history list_entries", logger):
-            with psycopg.connect(self._dsn, row_factory=dict_row) as conn:
-                rows = conn.execute(
-                    """
-                    SELECT id, result_id, original_url, created_at
-                    FROM generation_history
-                    WHERE session_id = %s
-                    ORDER BY created_at ASC
-                    LIMIT %s
-                    """,
-                    (session_id, fetch_limit),
+            with self._pool.connection() as conn:
+                rows = conn.cursor(row_factory=dict_row).execute(
+                    LIST_HISTORY_SQL, (session_id, fetch_limit), prepare=True
                 ).fetchall()
 
         return [
@@ -2,16 +2,22 @@
 
 from __future__ import annotations
 
+import hashlib
 import logging
+import os
 import re
+import struct
 from pathlib import Path
 from dataclasses import dataclass
-from typing import Iterable, Optional
+from typing import BinaryIO, Iterable, Iterator, Optional
 from uuid import UUID, uuid4
 
-import psycopg
+from psycopg import Connection
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 
+from .db import lock_schema
+from .history import GenerationHistoryStore
 from .timing import log_timing
 
 logger = logging.getLogger(__name__)
@@ -24,6 +30,78 @@ IMAGE_MIME_TYPES = {
     ".gif": "image/gif",
 }
 
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Each streamed chunk is one substring() round-trip, so reads use larger slices.
+ASSET_STREAM_CHUNK_SIZE = 256 * 1024
+
+# Binary COPY framing: signature, flags, header extension length, then one tuple.
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_TRAILER = struct.pack("!h", -1)
+_COPY_NULL = struct.pack("!i", -1)
+_COPY_ASSET_SQL = """
+    COPY image_assets
+    (id, session_id, role, filename, content_type, content_hash, image_bytes)
+    FROM STDIN WITH (FORMAT BINARY)
+"""
+_ASSET_SLICE_SQL = "SELECT substring(image_bytes FROM %s FOR %s) FROM image_assets WHERE id = %s"
+# Below this size a plain INSERT is cheaper than setting up a COPY.
+COPY_INSERT_THRESHOLD = 64 * 1024
+# Generated outputs are looked up by digest so byte-identical results reuse one row.
+_FIND_DUPLICATE_SQL = """
+    SELECT id FROM image_assets
+    WHERE session_id = %s AND role = %s AND content_hash = %s AND deleted_at IS NULL
+    LIMIT 1
+"""
+
+_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS image_assets (
+        id UUID PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        filename TEXT,
+        content_type TEXT NOT NULL,
+        image_bytes BYTEA NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        last_accessed TIMESTAMPTZ,
+        deleted_at TIMESTAMPTZ,
+        pinned BOOLEAN NOT NULL DEFAULT FALSE,
+        content_hash BYTEA
+    );
+    -- Image payloads are already compressed, so TOAST stores them out of line as-is.
+    ALTER TABLE image_assets ALTER COLUMN image_bytes SET STORAGE EXTERNAL;
+    CREATE INDEX IF NOT EXISTS image_assets_session_idx
+    ON image_assets (session_id);
+    ALTER TABLE image_assets
+        ADD COLUMN IF NOT EXISTS last_accessed TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS pinned BOOLEAN NOT NULL DEFAULT FALSE,
+        ADD COLUMN IF NOT EXISTS content_hash BYTEA;
+    CREATE INDEX IF NOT EXISTS image_assets_content_hash_idx
+    ON image_assets (session_id, content_hash)
+    WHERE content_hash IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS image_assets_cleanup_idx
+    ON image_assets (deleted_at, role, created_at);
+    CREATE INDEX IF NOT EXISTS image_assets_retention_idx
+    ON image_assets (role, created_at)
+    WHERE deleted_at IS NULL AND pinned IS NOT TRUE;
+"""
+_SCHEMA_CURRENT_SQL = """
+    SELECT to_regclass('image_assets_session_idx') IS NOT NULL
+       AND to_regclass('image_assets_cleanup_idx') IS NOT NULL
+       AND to_regclass('image_assets_retention_idx') IS NOT NULL
+       AND to_regclass('image_assets_content_hash_idx') IS NOT NULL
+       AND (
+           SELECT count(*) = 5
+           FROM pg_attribute
+           WHERE attrelid = to_regclass('image_assets')
+             AND NOT attisdropped
+             AND (
+                 attname IN ('last_accessed', 'deleted_at', 'pinned', 'content_hash')
+                 OR (attname = 'image_bytes' AND attstorage = 'e')
+             )
+       )
+"""
+
 MIME_EXTENSIONS = {
     "image/png": ".png",
     "image/jpeg": ".jpg",
@@ -33,6 +111,10 @@ MIME_EXTENSIONS = {
 }
 
 
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+_SPACE_TO_UNDERSCORE = str.maketrans({" ": "_"})
+
+
 class StorageError(ValueError):
     pass
 
@@ -43,7 +125,7 @@ class StoredUpload:
     original_name: str
     suffix: str
     content_type: str
-    image_bytes: bytes
+    image_bytes: Optional[bytes] = None
 
 
 @dataclass(frozen=True)
@@ -55,51 +137,36 @@ class ImageAsset:
     role: str
 
 
+@dataclass(frozen=True)
+class AssetStream:
+    asset_id: str
+    content_type: str
+    filename: Optional[str]
+    role: str
+    size: int
+    chunks: Iterator[bytes]
+
+
 class ImageAssetStore:
-    def __init__(self, dsn: str, allowed_extensions: Iterable[str]) -> None:
-        self._dsn = dsn
-        self._allowed = {ext.lower() for ext in allowed_extensions}
+    def __init__(self, pool: ConnectionPool, allowed_extensions: Iterable[str]) -> None:
+        self._pool = pool
+        # Stored with the leading dot so a suffix slice can be looked up directly.
+        self._allowed_suffixes = frozenset(
+            f".{ext.lower().lstrip('.')}" for ext in allowed_extensions
+        )
 
     def ensure_schema(self) -> None:
         with log_timing("db image_assets ensure_schema", logger):
-            with psycopg.connect(self._dsn) as conn:
-                conn.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS image_assets (
-                        id UUID PRIMARY KEY,
-                        session_id TEXT NOT NULL,
-                        role TEXT NOT NULL,
-                        filename TEXT,
-                        content_type TEXT NOT NULL,
-                        image_bytes BYTEA NOT NULL,
-                        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                        last_accessed TIMESTAMPTZ,
-                        deleted_at TIMESTAMPTZ,
-                        pinned BOOLEAN NOT NULL DEFAULT FALSE
-                    )
-                    """
-                )
-                conn.execute(
-                    """
-                    CREATE INDEX IF NOT EXISTS image_assets_session_idx
-                    ON image_assets (session_id)
-                    """
-                )
-                conn.execute(
-                    "ALTER TABLE image_assets ADD COLUMN IF NOT EXISTS last_accessed TIMESTAMPTZ"
-                )
-                conn.execute(
-                    "ALTER TABLE image_assets ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ"
-                )
-                conn.execute(
-                    "ALTER TABLE image_assets ADD COLUMN IF NOT EXISTS pinned BOOLEAN NOT NULL DEFAULT FALSE"
-                )
-                conn.execute(
-                    """
-                    CREATE INDEX IF NOT EXISTS image_assets_cleanup_idx
-                    ON image_assets (deleted_at, role, created_at)
-                    """
-                )
+            with self._pool.connection() as conn:
+                # A single catalog probe lets an up-to-date database skip the DDL and its locks.
+                if conn.execute(_SCHEMA_CURRENT_SQL).fetchone()[0]:
+                    return
+                # Booting workers migrate one at a time; the rest re-probe and skip the DDL.
+                lock_schema(conn)
+                if conn.execute(_SCHEMA_CURRENT_SQL).fetchone()[0]:
+                    return
+                # No parameters, so the whole script goes out in one simple-protocol round-trip.
+                conn.execute(_SCHEMA_SQL)
 
     def save_upload_bytes(
         self,
@@ -108,15 +175,7 @@ class ImageAssetStore:
         image_bytes: bytes,
         session_id: str,
     ) -> StoredUpload:
-        # Validate file metadata and whitelist extensions before storage.
-        if not filename:
-            raise StorageError("Please select an image.")
-
-        safe_name = _secure_filename(filename)
-        suffix = _normalize_suffix(_suffix_from_name(safe_name))
-        if not suffix or suffix.lstrip(".") not in self._allowed:
-            raise StorageError("Unsupported file type. Use PNG, JPG, JPEG, GIF, or WEBP.")
-
+        safe_name, suffix = self._validate_upload_name(filename)
         if not image_bytes:
             raise StorageError("Uploaded file is empty.")
 
@@ -138,6 +197,46 @@ class ImageAssetStore:
             image_bytes=image_bytes,
         )
 
+    def save_upload_stream(
+        self,
+        filename: str,
+        content_type: Optional[str],
+        stream: BinaryIO,
+        session_id: str,
+        copy_to: Optional[BinaryIO] = None,
+    ) -> StoredUpload:
+        """Store an upload by copying it to Postgres in chunks, optionally teeing to copy_to."""
+        safe_name, suffix = self._validate_upload_name(filename)
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        if not size:
+            raise StorageError("Uploaded file is empty.")
+
+        content_type = _resolve_content_type(suffix, content_type)
+        asset_id = uuid4()
+        row_prefix = _copy_row_prefix(asset_id, session_id, "upload", safe_name, content_type, size)
+        with log_timing("db stream image_assets", logger):
+            with self._pool.connection() as conn:
+                with conn.cursor().copy(_COPY_ASSET_SQL) as copy:
+                    copy.write(_COPY_HEADER + row_prefix)
+                    written = 0
+                    while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+                        written += len(chunk)
+                        copy.write(chunk)
+                        if copy_to is not None:
+                            copy_to.write(chunk)
+                    if written != size:
+                        raise StorageError("Upload changed while it was being stored.")
+                    copy.write(_COPY_TRAILER)
+
+        return StoredUpload(
+            asset_id=str(asset_id),
+            original_name=safe_name,
+            suffix=suffix,
+            content_type=content_type,
+        )
+
     def save_bytes(
         self,
         session_id: str,
@@ -146,15 +245,35 @@ class ImageAssetStore:
         filename: Optional[str] = None,
         role: str = "result",
     ) -> str:
-        asset_id = uuid4()
-        self._insert_asset(
-            asset_id=asset_id,
-            session_id=session_id,
-            role=role,
-            filename=filename,
-            content_type=content_type,
-            image_bytes=image_bytes,
-        )
+        with log_timing("db insert image_assets", logger):
+            with self._pool.connection() as conn:
+                asset_id = _store_deduplicated(
+                    conn, session_id, role, filename, content_type, image_bytes
+                )
+        return str(asset_id)
+
+    def save_bytes_with_history(
+        self,
+        history: GenerationHistoryStore,
+        session_id: str,
+        image_bytes: bytes,
+        content_type: str,
+        original_url: Optional[str],
+        filename: Optional[str] = None,
+        role: str = "result",
+    ) -> str:
+        """Stores a result and its history entry in one connection and transaction."""
+        with log_timing("db insert image_assets + history", logger):
+            with self._pool.connection() as conn:
+                asset_id = _store_deduplicated(
+                    conn, session_id, role, filename, content_type, image_bytes
+                )
+                # A savepoint lets a history failure roll back alone; the result still commits.
+                try:
+                    with conn.transaction():
+                        history.add_entry_on(conn, session_id, asset_id, original_url)
+                except Exception as exc:
+                    logger.warning("Failed to record history: %s", exc)
         return str(asset_id)
 
     def get_asset(self, session_id: str, asset_id: str) -> Optional[ImageAsset]:
@@ -163,21 +282,17 @@ class ImageAssetStore:
             return None
 
         with log_timing(f"db get_asset {asset_uuid}", logger):
-            with psycopg.connect(self._dsn, row_factory=dict_row) as conn:
-                row = conn.execute(
+            with self._pool.connection() as conn:
+                # Touch last_accessed for retention tracking and read the row in one statement;
+                # binary results deliver the BYTEA as raw bytes rather than hex text.
+                row = conn.cursor(binary=True, row_factory=dict_row).execute(
                     """
-                    SELECT id, filename, content_type, image_bytes, role
-                    FROM image_assets
+                    UPDATE image_assets SET last_accessed = NOW()
                     WHERE id = %s AND session_id = %s
+                    RETURNING id, filename, content_type, image_bytes, role
                     """,
                     (asset_uuid, session_id),
                 ).fetchone()
-                if row:
-                    # Update last_accessed for retention tracking.
-                    conn.execute(
-                        "UPDATE image_assets SET last_accessed = NOW() WHERE id = %s",
-                        (asset_uuid,),
-                    )
 
         if not row:
             return None
@@ -190,6 +305,73 @@ class ImageAssetStore:
             role=row["role"],
         )
 
+    def open_asset_stream(
+        self,
+        session_id: str,
+        asset_id: str,
+        chunk_size: int = ASSET_STREAM_CHUNK_SIZE,
+    ) -> Optional[AssetStream]:
+        """Fetch asset metadata plus the first chunk; the rest is read lazily by slice."""
+        asset_uuid = _coerce_uuid(asset_id)
+        if not asset_uuid:
+            return None
+
+        with log_timing(f"db open_asset_stream {asset_uuid}", logger):
+            with self._pool.connection() as conn:
+                row = conn.cursor(binary=True, row_factory=dict_row).execute(
+                    """
+                    UPDATE image_assets SET last_accessed = NOW()
+                    WHERE id = %s AND session_id = %s
+                    RETURNING id, filename, content_type, role,
+                              octet_length(image_bytes) AS size,
+                              substring(image_bytes FROM 1 FOR %s) AS head
+                    """,
+                    (asset_uuid, session_id, chunk_size),
+                ).fetchone()
+
+        if not row:
+            return None
+
+        return AssetStream(
+            asset_id=str(row["id"]),
+            content_type=row["content_type"],
+            filename=row["filename"],
+            role=row["role"],
+            size=row["size"],
+            chunks=self._iter_chunks(asset_uuid, bytes(row["head"]), row["size"], chunk_size),
+        )
+
+    def _iter_chunks(
+        self, asset_uuid: UUID, head: bytes, size: int, chunk_size: int
+    ) -> Iterator[bytes]:
+        yield head
+        offset = len(head)
+        while offset < size:
+            # A connection is held per slice only, so slow or abandoned downloads
+            # never pin a pooled connection between chunks.
+            with self._pool.connection() as conn:
+                row = conn.cursor(binary=True).execute(
+                    _ASSET_SLICE_SQL, (offset + 1, chunk_size, asset_uuid), prepare=True
+                ).fetchone()
+            if not row or not row[0]:
+                # Content-Length is already sent; failing aborts the response rather
+                # than ending it short as if the download were complete.
+                raise StorageError(f"Asset {asset_uuid} disappeared while streaming.")
+            chunk = bytes(row[0])
+            offset += len(chunk)
+            yield chunk
+
+    def _validate_upload_name(self, filename: str) -> tuple[str, str]:
+        # Validate file metadata and whitelist extensions before storage.
+        if not filename:
+            raise StorageError("Please select an image.")
+
+        safe_name = _secure_filename(filename)
+        suffix = _extract_allowed_suffix(safe_name, self._allowed_suffixes)
+        if suffix is None:
+            raise StorageError("Unsupported file type. Use PNG, JPG, JPEG, GIF, or WEBP.")
+        return safe_name, suffix
+
     def _insert_asset(
         self,
         asset_id: UUID,
@@ -200,33 +382,103 @@ class ImageAssetStore:
         image_bytes: bytes,
     ) -> None:
         with log_timing("db insert image_assets", logger):
-            with psycopg.connect(self._dsn) as conn:
-                conn.execute(
-                    """
-                    INSERT INTO image_assets
-                    (id, session_id, role, filename, content_type, image_bytes)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    """,
-                    (asset_id, session_id, role, filename, content_type, image_bytes),
-                )
+            with self._pool.connection() as conn:
+                _write_asset(conn, asset_id, session_id, role, filename, content_type, image_bytes)
+
+
+def _write_asset(
+    conn: Connection,
+    asset_id: UUID,
+    session_id: str,
+    role: str,
+    filename: Optional[str],
+    content_type: str,
+    image_bytes: bytes,
+    content_hash: Optional[bytes] = None,
+) -> None:
+    if len(image_bytes) >= COPY_INSERT_THRESHOLD:
+        # Large blobs go out as raw COPY frames instead of an extended-protocol parameter.
+        row_prefix = _copy_row_prefix(
+            asset_id, session_id, role, filename, content_type, len(image_bytes), content_hash
+        )
+        with conn.cursor().copy(_COPY_ASSET_SQL) as copy:
+            copy.write(_COPY_HEADER + row_prefix)
+            copy.write(image_bytes)
+            copy.write(_COPY_TRAILER)
+        return
+
+    # %b sends the blob as a binary parameter, skipping bytea hex escaping on both ends.
+    conn.execute(
+        """
+        INSERT INTO image_assets
+        (id, session_id, role, filename, content_type, content_hash, image_bytes)
+        VALUES (%s, %s, %s, %s, %s, %b, %b)
+        """,
+        (asset_id, session_id, role, filename, content_type, content_hash, image_bytes),
+    )
+
+
+def _store_deduplicated(
+    conn: Connection,
+    session_id: str,
+    role: str,
+    filename: Optional[str],
+    content_type: str,
+    image_bytes: bytes,
+) -> UUID:
+    """Returns the id of an identical live asset for the session, inserting one if needed."""
+    content_hash = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    row = conn.execute(
+        _FIND_DUPLICATE_SQL, (session_id, role, content_hash), prepare=True
+    ).fetchone()
+    if row:
+        return row[0]
+    asset_id = uuid4()
+    _write_asset(
+        conn, asset_id, session_id, role, filename, content_type, image_bytes, content_hash
+    )
+    return asset_id
 
 
 def extension_for_mime(content_type: str) -> str:
     return MIME_EXTENSIONS.get(content_type, ".png")
 
 
-def _normalize_suffix(suffix: str) -> str:
-    if not suffix:
-        return ""
-    if not suffix.startswith("."):
-        suffix = f".{suffix}"
-    return suffix.lower()
+def _copy_field(value: bytes) -> bytes:
+    return struct.pack("!i", len(value)) + value
+
+
+def _copy_row_prefix(
+    asset_id: UUID,
+    session_id: str,
+    role: str,
+    filename: Optional[str],
+    content_type: str,
+    size: int,
+    content_hash: Optional[bytes] = None,
+) -> bytes:
+    """Binary COPY tuple up to the image_bytes length word; the payload follows it."""
+    return b"".join(
+        (
+            struct.pack("!h", 7),
+            _copy_field(asset_id.bytes),
+            _copy_field(session_id.encode("utf-8")),
+            _copy_field(role.encode("utf-8")),
+            _copy_field(filename.encode("utf-8")) if filename is not None else _COPY_NULL,
+            _copy_field(content_type.encode("utf-8")),
+            _copy_field(content_hash) if content_hash is not None else _COPY_NULL,
+            struct.pack("!i", size),
+        )
+    )
 
 
-def _suffix_from_name(name: str) -> str:
-    if "." not in name:
-        return ""
-    return "." + name.rsplit(".", 1)[-1]
+def _extract_allowed_suffix(name: str, allowed_suffixes: frozenset[str]) -> Optional[str]:
+    """Lowercased ".ext" of name when it is allow-listed: one rfind, one slice, one lookup."""
+    dot = name.rfind(".")
+    if dot < 0 or dot == len(name) - 1:
+        return None
+    suffix = name[dot:].lower()
+    return suffix if suffix in allowed_suffixes else None
 
 
 def _resolve_content_type(suffix: str, mimetype: Optional[str]) -> str:
@@ -239,11 +491,8 @@ def _secure_filename(name: str) -> str:
     safe = (name or "").strip()
     if not safe:
         return "upload"
-    safe = Path(safe).name
-    safe = safe.replace(" ", "_")
-    safe = re.sub(r"[^A-Za-z0-9_.-]", "", safe)
-    safe = safe.strip("._")
-    return safe or "upload"
+    safe = _UNSAFE_FILENAME_CHARS.sub("", Path(safe).name.translate(_SPACE_TO_UNDERSCORE))
+    return safe.strip("._") or "upload"
 
 
 def _coerce_uuid(value: str) -> Optional[UUID]:
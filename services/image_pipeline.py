@@ -2,23 +2,36 @@
 
 from __future__ import annotations
 
+import io
 import logging
+import threading
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Mapping, Optional
 
 from PIL import Image
 
-from .ai.base import ImageEditor
+from .ai import build_image_editor, describe_editor
 from .timing import log_timing
 
+if TYPE_CHECKING:
+    from .ai.base import ImageEditor
+
+# Modes whose PNG already matches what the RGB re-encode would produce visually.
+_PASSTHROUGH_MODES = frozenset({"RGB", "L"})
+# Source PNGs are transient and re-read right away, so DEFLATE effort buys little.
+PNG_COMPRESS_LEVEL = 1
+
 
 @dataclass(frozen=True)
 class ProcessingResult:
-    result_path: Path
+    # The encoded PNG; callers store it directly rather than reading a file back.
+    result_bytes: bytes
     prompt_used: Optional[str]
     status_message: str
     warning_message: Optional[str]
+    # Only set when process() was asked to also write the result to a directory.
+    result_path: Optional[Path] = None
 
 
 class AIProcessingError(RuntimeError):
@@ -28,15 +41,15 @@ class AIProcessingError(RuntimeError):
 class ImagePipeline:
     def __init__(
         self,
-        result_dir: Path,
         editor: Optional[ImageEditor],
         ai_label: str,
         ai_suffix: str,
+        png_compress_level: int = PNG_COMPRESS_LEVEL,
     ) -> None:
-        self._result_dir = result_dir
         self._editor = editor
         self._ai_label = ai_label
         self._ai_suffix = ai_suffix
+        self._png_compress_level = png_compress_level
 
     @property
     def ai_available(self) -> bool:
@@ -48,20 +61,20 @@ class ImagePipeline:
 
     def process(
         self,
-        source_path: Path,
+        source: Path | bytes,
         prompt: str,
         output_stem: str,
         style_rules: str | None = None,
         style_reference_bytes: bytes | None = None,
         result_dir: Path | None = None,
     ) -> ProcessingResult:
+        """Runs the AI edit or returns the source; the PNG is only written out if result_dir is set."""
         logger = logging.getLogger(__name__)
         with log_timing("pipeline process", logger):
-            output_dir = result_dir or self._result_dir
-            output_dir.mkdir(parents=True, exist_ok=True)
             prompt_used = prompt or None
             warning_message = None
-            final_path: Optional[Path] = None
+            result_bytes: Optional[bytes] = None
+            result_name = f"{output_stem}_source.png"
             status_message = ""
 
             if prompt:
@@ -72,7 +85,7 @@ class ImagePipeline:
                     with log_timing(f"ai generate ({self._ai_label})", logger):
                         ai_bytes = (
                             self._editor.edit_image(
-                                source_path,
+                                source,
                                 prompt,
                                 style_rules=style_rules,
                                 style_reference_bytes=style_reference_bytes,
@@ -85,23 +98,90 @@ class ImagePipeline:
                 if not ai_bytes:
                     # Treat empty AI responses as a failed generation.
                     raise AIProcessingError("AI generation failed; please retry.")
-                final_path = output_dir / f"{output_stem}_{self._ai_suffix}.png"
-                final_path.write_bytes(ai_bytes)
+                result_name = f"{output_stem}_{self._ai_suffix}.png"
+                result_bytes = ai_bytes
                 status_message = f"AI variation applied using {self._ai_label}"
 
-            if final_path is None:
-                final_path = output_dir / f"{output_stem}_source.png"
-                with log_timing("pipeline save source", logger):
-                    with Image.open(source_path) as img:
-                        if img.mode != "RGB":
-                            img = img.convert("RGB")
-                        img.save(final_path, "PNG")
-                if not status_message:
-                    status_message = "Source image returned"
+            if result_bytes is None:
+                # Image.open only parses the header, so one handle serves both the
+                # pass-through check and the re-encode.
+                source_bytes = source if isinstance(source, bytes) else None
+                img = Image.open(io.BytesIO(source_bytes) if source_bytes is not None else source)
+                try:
+                    if img.format == "PNG" and img.mode in _PASSTHROUGH_MODES:
+                        with log_timing("pipeline passthrough source", logger):
+                            result_bytes = (
+                                source_bytes if source_bytes is not None else source.read_bytes()
+                            )
+                    else:
+                        with log_timing("pipeline save source", logger):
+                            rgb = img if img.mode == "RGB" else img.convert("RGB")
+                            buffer = io.BytesIO()
+                            rgb.save(
+                                buffer,
+                                "PNG",
+                                compress_level=self._png_compress_level,
+                                optimize=False,
+                            )
+                            result_bytes = buffer.getvalue()
+                finally:
+                    img.close()
+                status_message = "Source image returned"
+
+            result_path: Optional[Path] = None
+            if result_dir is not None:
+                # Callers pass a directory they already created.
+                result_path = result_dir / result_name
+                result_path.write_bytes(result_bytes)
 
             return ProcessingResult(
-                result_path=final_path,
+                result_bytes=result_bytes,
+                result_path=result_path,
                 prompt_used=prompt_used,
                 status_message=status_message,
                 warning_message=warning_message,
             )
+
+
+# Fast/normal pipeline variants keyed by (id(config snapshot), fast_mode).
+_PIPELINE_CACHE: dict[tuple[int, bool], ImagePipeline] = {}
+_pipeline_cache_lock = threading.Lock()
+
+
+def build_pipeline(config_values: Mapping[str, object], fast_mode: bool) -> ImagePipeline:
+    """Builds a pipeline whose editor runs the fast or the normal Gemini model."""
+    config_values = {**config_values, "FAST_MODE": fast_mode}
+    provider = str(config_values.get("IMAGE_PROVIDER", "nano_banana"))
+    if fast_mode:
+        model_name = str(config_values.get("GEMINI_MODEL_FAST", "gemini-2.5-flash-image"))
+    else:
+        model_name = str(config_values.get("GEMINI_MODEL", "gemini-3-pro-image-preview"))
+    ai_label, ai_suffix = describe_editor(provider, model_name)
+    return ImagePipeline(
+        editor=build_image_editor(config_values),
+        ai_label=ai_label,
+        ai_suffix=ai_suffix,
+        png_compress_level=int(
+            config_values.get("PIPELINE_PNG_COMPRESS_LEVEL", PNG_COMPRESS_LEVEL)
+        ),
+    )
+
+
+def select_pipeline(
+    config_values: Mapping[str, object], base_pipeline: ImagePipeline, fast_mode: bool
+) -> ImagePipeline:
+    """Returns base_pipeline for the configured mode, else a cached toggled-mode variant."""
+    if fast_mode == bool(config_values.get("FAST_MODE", False)):
+        return base_pipeline
+
+    key = (id(config_values), fast_mode)
+    cached = _PIPELINE_CACHE.get(key)
+    if cached is not None:
+        return cached
+    # Threaded and gevent callers can race here; only one of them builds the editor.
+    with _pipeline_cache_lock:
+        cached = _PIPELINE_CACHE.get(key)
+        if cached is None:
+            cached = build_pipeline(config_values, fast_mode)
+            _PIPELINE_CACHE[key] = cached
+    return cached
@@ -0,0 +1,97 @@
+"""Push notifications for Celery task state changes over Redis pub/sub."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from redis import asyncio as redis_asyncio
+
+logger = logging.getLogger(__name__)
+
+REDIS_SCHEMES = ("redis://", "rediss://", "unix://")
+
+
+class JobEventListener:
+    """Wakes job streams when Celery's Redis backend publishes a task update.
+
+    The Redis result backend publishes every stored task state on the task's
+    meta key channel, so a single pattern subscription covers all jobs.
+    """
+
+    def __init__(
+        self,
+        redis_url: str,
+        key_prefix: str,
+        on_update: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self._redis_url = redis_url
+        self._key_prefix = key_prefix
+        self._on_update = on_update
+        self._waiters: dict[str, set[asyncio.Event]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, job_id: str) -> asyncio.Event:
+        self._ensure_started()
+        event = asyncio.Event()
+        self._waiters.setdefault(job_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, job_id: str, event: asyncio.Event) -> None:
+        waiters = self._waiters.get(job_id)
+        if waiters is None:
+            return
+        waiters.discard(event)
+        if not waiters:
+            del self._waiters[job_id]
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._listen())
+
+    async def _listen(self) -> None:
+        client = redis_asyncio.from_url(self._redis_url)
+        pattern = f"{self._key_prefix}*"
+        prefix_len = len(self._key_prefix)
+        backoff = 1.0
+        while True:
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.psubscribe(pattern)
+                    backoff = 1.0
+                    async for message in pubsub.listen():
+                        if message.get("type") != "pmessage":
+                            continue
+                        channel = message["channel"]
+                        if isinstance(channel, bytes):
+                            channel = channel.decode("utf-8", "replace")
+                        job_id = channel[prefix_len:]
+                        if self._on_update is not None:
+                            self._on_update(job_id)
+                        for event in self._waiters.get(job_id, ()):
+                            event.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                # Streams keep their fallback polling while the subscription reconnects.
+                logger.warning("Job event subscription failed: %s", exc)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+
+def build_job_event_listener(
+    celery_app: object, on_update: Optional[Callable[[str], None]] = None
+) -> Optional[JobEventListener]:
+    """Returns a listener when the Celery result backend is Redis, else None."""
+    backend_url = str(getattr(getattr(celery_app, "conf", None), "result_backend", "") or "")
+    if not backend_url.startswith(REDIS_SCHEMES):
+        return None
+    try:
+        key_prefix = celery_app.backend.get_key_for_task("")
+    except Exception as exc:  # pragma: no cover
+        logger.warning("Job events disabled; could not resolve task key prefix: %s", exc)
+        return None
+    if isinstance(key_prefix, bytes):
+        key_prefix = key_prefix.decode("utf-8")
+    return JobEventListener(backend_url, key_prefix, on_update=on_update)
@@ -0,0 +1,25 @@
+"""Runs CPU-bound work off the gevent hub when the process is monkey-patched."""
+
+from __future__ import annotations
+
+from typing import Callable, TypeVar
+
+T = TypeVar("T")
+
+
+def gevent_patched() -> bool:
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def run_cpu_bound(func: Callable[..., T], *args, **kwargs) -> T:
+    """Runs CPU-heavy work on a native thread when the worker uses the gevent pool."""
+    if gevent_patched():
+        from gevent import get_hub
+
+        # PIL releases the GIL while coding, so other greenlets keep running meanwhile.
+        return get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
@@ -2,25 +2,35 @@
 
 from __future__ import annotations
 
+import hashlib
 import json
 import logging
+import os
+import re
+import tempfile
+import threading
+import time
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 
-import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 
+from .image_assets import extension_for_mime
 from .timing import log_timing
 
 logger = logging.getLogger(__name__)
 
-MIME_EXTENSIONS = {
-    "image/png": ".png",
-    "image/jpeg": ".jpg",
-    "image/jpg": ".jpg",
-    "image/webp": ".webp",
-}
+# Styles change only when init_database reseeds them, so records are reused for a while.
+STYLE_CACHE_TTL_SECONDS = 300.0
+STYLE_CACHE_MAX_ENTRIES = 64
+# Materialized reference files live in their own subdirectory with a bounded file count.
+STYLE_REFERENCE_SUBDIR = "styles"
+STYLE_REFERENCE_DISK_MAX_FILES = 64
+
+_JSON_START_RE = re.compile(r"[{\[]")
+_JSON_DECODER = json.JSONDecoder()
 
 
 @dataclass(frozen=True)
@@ -30,36 +40,153 @@ class StyleSummary:
 
 
 @dataclass(frozen=True)
-class StyleRecord(StyleSummary):
+class StyleMeta(StyleSummary):
     rules_text: str
-    reference_bytes: bytes
     reference_mime: str
     style_profile: Optional[dict]
 
 
+@dataclass(frozen=True)
+class StyleRecord(StyleMeta):
+    reference_bytes: bytes
+
+
+@dataclass(frozen=True)
+class StyleBundle:
+    style: StyleMeta
+    rules: str
+    reference_bytes: Optional[bytes]
+
+
 class PostgresStyleCatalog:
-    def __init__(self, dsn: str, max_rules_chars: int) -> None:
-        self._dsn = dsn
+    def __init__(self, pool: ConnectionPool, max_rules_chars: int) -> None:
+        self._pool = pool
         self._max_rules_chars = max_rules_chars
+        self._meta_cache: dict[str, tuple[float, StyleMeta]] = {}
+        self._reference_cache: dict[str, tuple[float, bytes]] = {}
+        self._reference_paths: dict[str, tuple[float, Path]] = {}
+        self._rules_cache: dict[tuple[str, int], str] = {}
+        # Keyed by style id and checked by identity: cached metas hand back the same profile
+        # dict until they are refetched, and holding it here keeps its id from being reused.
+        self._profile_rules_cache: dict[str, tuple[dict, str]] = {}
+        self._cache_lock = threading.Lock()
 
     def list_styles(self) -> list[StyleSummary]:
         with log_timing("db list_styles", logger):
-            with psycopg.connect(self._dsn, row_factory=dict_row) as conn:
-                rows = conn.execute(
+            with self._pool.connection() as conn:
+                rows = conn.cursor(row_factory=dict_row).execute(
                     "SELECT style_id, style_name FROM styles ORDER BY style_name ASC"
                 ).fetchall()
         return [StyleSummary(style_id=row["style_id"], name=row["style_name"]) for row in rows]
 
-    def get_style(self, style_id: str) -> Optional[StyleRecord]:
+    def get_style_meta(self, style_id: str) -> Optional[StyleMeta]:
+        """Returns everything but the reference image, so rules-only callers skip the BYTEA."""
+        safe_id = Path(style_id).name
+        if safe_id != style_id:
+            return None
+
+        now = time.monotonic()
+        cached = self._meta_cache.get(safe_id)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        meta = self._fetch_style_meta(safe_id)
+        if meta is not None:
+            self._remember(self._meta_cache, safe_id, meta, now)
+        return meta
+
+    def get_reference_bytes(self, style_id: str) -> Optional[bytes]:
+        """Fetches only the reference image; it is detoasted when a caller actually needs it."""
+        safe_id = Path(style_id).name
+        if safe_id != style_id:
+            return None
+
+        now = time.monotonic()
+        cached = self._reference_cache.get(safe_id)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        with log_timing(f"db get_reference_bytes {safe_id}", logger):
+            with self._pool.connection() as conn:
+                row = conn.cursor(binary=True).execute(
+                    "SELECT reference_image FROM styles WHERE style_id = %s",
+                    (safe_id,),
+                ).fetchone()
+
+        if not row or not row[0]:
+            return None
+        reference_bytes = bytes(row[0])
+        self._remember(self._reference_cache, safe_id, reference_bytes, now)
+        return reference_bytes
+
+    def get_style_bundle(
+        self, style_id: str, include_reference: bool = True
+    ) -> Optional[StyleBundle]:
+        """Returns metadata, formatted rules, and optionally the reference in one query."""
         safe_id = Path(style_id).name
         if safe_id != style_id:
             return None
 
-        with log_timing(f"db get_style {safe_id}", logger):
-            with psycopg.connect(self._dsn, row_factory=dict_row) as conn:
-                row = conn.execute(
+        now = time.monotonic()
+        cached_meta = self._meta_cache.get(safe_id)
+        cached_reference = self._reference_cache.get(safe_id)
+        meta = cached_meta[1] if cached_meta is not None and cached_meta[0] > now else None
+        reference_bytes = (
+            cached_reference[1]
+            if cached_reference is not None and cached_reference[0] > now
+            else None
+        )
+        if meta is None or (include_reference and reference_bytes is None):
+            # Cold cache: a single round-trip fills both the metadata and reference caches.
+            columns = "style_id, style_name, rules_text, reference_mime, style_profile"
+            if include_reference:
+                columns += ", reference_image"
+            with log_timing(f"db get_style_bundle {safe_id}", logger):
+                with self._pool.connection() as conn:
+                    row = conn.cursor(binary=True, row_factory=dict_row).execute(
+                        f"SELECT {columns} FROM styles WHERE style_id = %s",
+                        (safe_id,),
+                    ).fetchone()
+            if not row:
+                return None
+            meta = self._meta_from_row(row)
+            self._remember(self._meta_cache, safe_id, meta, now)
+            if include_reference and row["reference_image"]:
+                reference_bytes = bytes(row["reference_image"])
+                self._remember(self._reference_cache, safe_id, reference_bytes, now)
+
+        return StyleBundle(
+            style=meta,
+            rules=self.load_rules(meta),
+            reference_bytes=reference_bytes if include_reference else None,
+        )
+
+    def get_style(self, style_id: str) -> Optional[StyleRecord]:
+        """Deprecated: combines get_style_meta and get_reference_bytes into one record."""
+        meta = self.get_style_meta(style_id)
+        if meta is None:
+            return None
+        return StyleRecord(
+            style_id=meta.style_id,
+            name=meta.name,
+            rules_text=meta.rules_text,
+            reference_mime=meta.reference_mime,
+            style_profile=meta.style_profile,
+            reference_bytes=self.get_reference_bytes(meta.style_id) or b"",
+        )
+
+    def _remember(self, cache: dict, key: str, value: object, now: float) -> None:
+        with self._cache_lock:
+            if len(cache) >= STYLE_CACHE_MAX_ENTRIES:
+                cache.clear()
+            cache[key] = (now + STYLE_CACHE_TTL_SECONDS, value)
+
+    def _fetch_style_meta(self, safe_id: str) -> Optional[StyleMeta]:
+        with log_timing(f"db get_style_meta {safe_id}", logger):
+            with self._pool.connection() as conn:
+                row = conn.cursor(row_factory=dict_row).execute(
                     """
-                    SELECT style_id, style_name, rules_text, reference_image, reference_mime, style_profile
+                    SELECT style_id, style_name, rules_text, reference_mime, style_profile
                     FROM styles
                     WHERE style_id = %s
                     """,
@@ -68,11 +195,17 @@ class PostgresStyleCatalog:
 
         if not row:
             return None
+        return self._meta_from_row(row)
 
+    def _meta_from_row(self, row: dict) -> StyleMeta:
         rules_text = row["rules_text"] or ""
         if self._max_rules_chars > 0 and len(rules_text) > self._max_rules_chars:
-            # Truncate long style guides to keep prompts bounded.
-            rules_text = rules_text[: self._max_rules_chars].rstrip()
+            # Truncate long style guides to keep prompts bounded; trailing whitespace is
+            # skipped by index so the trim costs one slice instead of slice plus rstrip.
+            end = self._max_rules_chars
+            while end > 0 and rules_text[end - 1].isspace():
+                end -= 1
+            rules_text = rules_text[:end]
 
         style_profile = row.get("style_profile")
         if style_profile:
@@ -85,35 +218,96 @@ class PostgresStyleCatalog:
             elif not isinstance(style_profile, dict):
                 style_profile = None
 
-        return StyleRecord(
+        return StyleMeta(
             style_id=row["style_id"],
             name=row["style_name"],
             rules_text=rules_text,
-            reference_bytes=row["reference_image"],
             reference_mime=row["reference_mime"],
             style_profile=style_profile,
         )
 
-    def load_rules(self, style: StyleRecord) -> str:
+    def load_rules(self, style: StyleMeta) -> str:
         if style.style_profile:
-            return _format_style_profile(style.style_profile)
-        return _format_rules_text(style.rules_text)
-
-    def materialize_reference(self, style: StyleRecord, output_dir: Path) -> Path:
+            cached_profile = self._profile_rules_cache.get(style.style_id)
+            if cached_profile is not None and cached_profile[0] is style.style_profile:
+                return cached_profile[1]
+            rules = _format_style_profile(style.style_profile)
+            with self._cache_lock:
+                if len(self._profile_rules_cache) >= STYLE_CACHE_MAX_ENTRIES:
+                    self._profile_rules_cache.clear()
+                self._profile_rules_cache[style.style_id] = (style.style_profile, rules)
+            return rules
+
+        key = (style.style_id, hash(style.rules_text))
+        cached = self._rules_cache.get(key)
+        if cached is not None:
+            return cached
+
+        rules = _format_rules_text(style.rules_text)
+        with self._cache_lock:
+            if len(self._rules_cache) >= STYLE_CACHE_MAX_ENTRIES:
+                self._rules_cache.clear()
+            self._rules_cache[key] = rules
+        return rules
+
+    def materialize_reference(self, style: StyleMeta, output_dir: Path) -> Path:
         safe_id = Path(style.style_id).name
-        ext = MIME_EXTENSIONS.get(style.reference_mime, ".png")
-        output_path = output_dir / f"style_{safe_id}{ext}"
-        if output_path.is_file():
-            return output_path
+        ext = extension_for_mime(style.reference_mime)
+        now = time.monotonic()
+        path_key = f"{output_dir}/{safe_id}"
+        cached = self._reference_paths.get(path_key)
+        # One access() call confirms a file this process already wrote is still there.
+        if cached is not None and cached[0] > now and os.access(cached[1], os.F_OK):
+            return cached[1]
+
+        cache_dir = output_dir / STYLE_REFERENCE_SUBDIR
+        reference_bytes = self.get_reference_bytes(safe_id)
+        if not reference_bytes:
+            return cache_dir / f"style_{safe_id}{ext}"
+
+        # Content-addressed names let every worker share one file and pick up reseeds.
+        digest = hashlib.blake2b(reference_bytes, digest_size=8).hexdigest()
+        output_path = cache_dir / f"style_{safe_id}_{digest}{ext}"
+        if not os.access(output_path, os.F_OK):
+            try:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                _write_atomic(output_path, reference_bytes)
+            except OSError as exc:
+                logger.warning("Failed to write style reference %s: %s", style.style_id, exc)
+                return output_path
+            _evict_oldest(cache_dir, STYLE_REFERENCE_DISK_MAX_FILES)
+        self._remember(self._reference_paths, path_key, output_path, now)
+        return output_path
 
-        if not style.reference_bytes:
-            return output_path
 
+def _write_atomic(path: Path, data: bytes) -> None:
+    # Readers see either no file or the complete file, never a partial write.
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, prefix=f".{path.stem}.", delete=False
+    ) as handle:
+        handle.write(data)
+    try:
+        os.replace(handle.name, path)
+    except OSError:
         try:
-            output_path.write_bytes(style.reference_bytes)
-        except OSError as exc:
-            logger.warning("Failed to write style reference %s: %s", style.style_id, exc)
-        return output_path
+            os.unlink(handle.name)
+        except OSError:
+            pass
+        raise
+
+
+def _evict_oldest(folder: Path, max_files: int) -> None:
+    # Only runs after a new file is written, so superseded reseed versions age out first.
+    try:
+        with os.scandir(folder) as entries:
+            files = [entry for entry in entries if entry.is_file(follow_symlinks=False)]
+        if len(files) <= max_files:
+            return
+        files.sort(key=lambda entry: entry.stat(follow_symlinks=False).st_mtime)
+        for entry in files[: len(files) - max_files]:
+            os.unlink(entry.path)
+    except OSError as exc:
+        logger.warning("Failed to trim style reference cache %s: %s", folder, exc)
 
 
 def _format_style_profile(profile: dict) -> str:
@@ -262,7 +456,12 @@ def _format_rules_text(text: str) -> str:
     json_blocks = []
     spans: list[tuple[int, int]] = []
     for obj, start, end in extracted:
-        json_blocks.append(json.dumps(obj, indent=2, ensure_ascii=True))
+        raw = text[start:end]
+        # Blocks that are already laid out over several lines are shown as written.
+        if "\n" in raw:
+            json_blocks.append(raw)
+        else:
+            json_blocks.append(json.dumps(obj, indent=2, ensure_ascii=True))
         spans.append((start, end))
 
     cleaned = _remove_spans(text, spans).strip()
@@ -291,20 +490,16 @@ def _remove_spans(text: str, spans: list[tuple[int, int]]) -> str:
 
 def _extract_json_blocks(text: str) -> list[tuple[object, int, int]]:
     results: list[tuple[object, int, int]] = []
-    decoder = json.JSONDecoder()
-    idx = 0
-    length = len(text)
-
-    while idx < length:
-        if text[idx] not in "{[":
-            idx += 1
-            continue
+    # The regex scan jumps between bracket candidates in C instead of stepping per character.
+    match = _JSON_START_RE.search(text)
+    while match:
+        idx = match.start()
         try:
-            obj, end = decoder.raw_decode(text, idx)
+            obj, end = _JSON_DECODER.raw_decode(text, idx)
         except Exception:
-            idx += 1
+            match = _JSON_START_RE.search(text, idx + 1)
             continue
         results.append((obj, idx, end))
-        idx = end
+        match = _JSON_START_RE.search(text, end)
 
     return results
@@ -0,0 +1,130 @@
+"""Session middleware: Redis-backed sessions and path-based session exemptions."""
+
+from __future__ import annotations
+
+import json
+import logging
+import re
+import secrets
+from typing import Any
+
+from redis import asyncio as redis_asyncio
+from redis.exceptions import RedisError
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY_PREFIX = "ivg:session:"
+_SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{43}$")
+
+
+class RedisSessionMiddleware:
+    """Stores the session dict in Redis and only an opaque random id in the cookie.
+
+    This avoids signing and base64-encoding the whole session on every response.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        redis_url: str,
+        session_cookie: str = "session",
+        max_age: int = 14 * 24 * 60 * 60,
+        same_site: str = "lax",
+        https_only: bool = False,
+    ) -> None:
+        self.app = app
+        self._redis = redis_asyncio.from_url(redis_url)
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.security_flags = "httponly; samesite=" + same_site.lower()
+        if https_only:
+            self.security_flags += "; secure"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        session_id = HTTPConnection(scope).cookies.get(self.session_cookie)
+        initial: dict = {}
+        if session_id and _SESSION_ID_RE.match(session_id):
+            # GETEX refreshes the TTL in the same round trip as the read.
+            try:
+                raw = await self._redis.getex(self._key(session_id), ex=self.max_age)
+            except RedisError as exc:
+                # Serve the request without its session rather than failing it outright.
+                logger.warning("Session read failed: %s", exc)
+                raw = None
+            if raw:
+                try:
+                    initial = json.loads(raw)
+                except ValueError:
+                    initial = {}
+        else:
+            session_id = None
+        scope["session"] = dict(initial)
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal session_id
+            if message["type"] == "http.response.start":
+                session = scope["session"]
+                headers = MutableHeaders(scope=message)
+                if session:
+                    if session_id is None:
+                        session_id = secrets.token_urlsafe(32)
+                    if session != initial:
+                        try:
+                            await self._redis.set(
+                                self._key(session_id), json.dumps(session), ex=self.max_age
+                            )
+                        except RedisError as exc:
+                            logger.warning("Session write failed: %s", exc)
+                    headers.append(
+                        "Set-Cookie",
+                        f"{self.session_cookie}={session_id}; path=/; "
+                        f"Max-Age={self.max_age}; {self.security_flags}",
+                    )
+                elif session_id is not None and initial:
+                    try:
+                        await self._redis.delete(self._key(session_id))
+                    except RedisError as exc:
+                        logger.warning("Session delete failed: %s", exc)
+                    headers.append(
+                        "Set-Cookie",
+                        f"{self.session_cookie}=null; path=/; "
+                        f"expires=Thu, 01 Jan 1970 00:00:00 GMT; {self.security_flags}",
+                    )
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return SESSION_KEY_PREFIX + session_id
+
+
+class SessionExemptPathsMiddleware:
+    """Runs a session middleware for every path except the exempt prefixes.
+
+    Static assets never touch the session, so they skip the cookie load and save.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        session_middleware: type,
+        exempt_prefixes: tuple[str, ...] = ("/static/",),
+        **options: Any,
+    ) -> None:
+        self.app = app
+        self.session_app = session_middleware(app, **options)
+        self.exempt_prefixes = exempt_prefixes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"].startswith(self.exempt_prefixes):
+            await self.app(scope, receive, send)
+            return
+        await self.session_app(scope, receive, send)
@@ -3,42 +3,62 @@
 from __future__ import annotations
 
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from tempfile import TemporaryDirectory
+from typing import Mapping
 from uuid import uuid4
 
+from celery.signals import (
+    worker_init,
+    worker_process_init,
+    worker_process_shutdown,
+    worker_shutdown,
+)
+from psycopg_pool import ConnectionPool
+
 if __package__:
     from .celery_app import BG_QUEUE, DEFAULT_QUEUE, celery_app
-    from .config import get_config_class
+    from .config import config_snapshot, get_config_class
     from .paths import RESULT_DIR, ensure_directories
     from .services import AppServices
-    from .services.ai import build_image_editor
-    from .services.background_removal import BackgroundRemovalService
+    from .services.ai import build_image_editor, describe_editor
+    from .services.background_removal import build_background_removal
+    from .services.db import create_pool
     from .services.history import GenerationHistoryStore
-    from .services.image_assets import ImageAssetStore, extension_for_mime
-    from .services.image_pipeline import ImagePipeline
+    from .services.image_assets import ImageAssetStore
+    from .services.image_pipeline import ImagePipeline, select_pipeline
+    from .services.offload import run_cpu_bound
     from .services.styles_postgres import PostgresStyleCatalog
 else:
     from celery_app import BG_QUEUE, DEFAULT_QUEUE, celery_app
-    from config import get_config_class
+    from config import config_snapshot, get_config_class
     from paths import RESULT_DIR, ensure_directories
     from services import AppServices
-    from services.ai import build_image_editor
-    from services.background_removal import BackgroundRemovalService
+    from services.ai import build_image_editor, describe_editor
+    from services.background_removal import build_background_removal
+    from services.db import create_pool
     from services.history import GenerationHistoryStore
-    from services.image_assets import ImageAssetStore, extension_for_mime
-    from services.image_pipeline import ImagePipeline
+    from services.image_assets import ImageAssetStore
+    from services.image_pipeline import ImagePipeline, select_pipeline
+    from services.offload import run_cpu_bound
     from services.styles_postgres import PostgresStyleCatalog
 
 logger = logging.getLogger(__name__)
 
 _services: AppServices | None = None
+_db_pool: ConnectionPool | None = None
 _config_class: type | None = None
+_services_lock = threading.Lock()
+
+
+_TRUTHY = frozenset({"1", "true", "yes", "on"})
 
 
 def _coerce_bool(value: object) -> bool:
     if isinstance(value, str):
-        return value.lower() in {"1", "true", "yes", "on"}
+        return value.lower() in _TRUTHY
     return bool(value)
 
 
@@ -53,50 +73,16 @@ def _auto_migrate_enabled(app_config: object) -> bool:
     return bool(getattr(app_config, "AUTO_MIGRATE", False))
 
 
-def _resolve_ai_metadata(config: dict) -> tuple[str, str]:
-    provider = str(config.get("IMAGE_PROVIDER", "nano_banana")).lower()
-    if provider == "nano_banana":
-        model_name = str(config.get("GEMINI_MODEL", "gemini-3-pro-image-preview"))
-        if _coerce_bool(config.get("FAST_MODE", False)):
-            model_name = str(config.get("GEMINI_MODEL_FAST", "gemini-2.5-flash-image"))
-        label_map = {
-            "gemini-3-pro-image-preview": "Gemini 3 Pro Image Preview",
-            "gemini-2.5-flash-image": "Gemini 2.5 Flash Image",
-        }
-        model_label = label_map.get(model_name, model_name)
-        return f"Nano Banana ({model_label})", "nano"
-    return "AI", "ai"
-
-
-def _build_background_removal(
-    app_config: object, fast_mode: bool
-) -> BackgroundRemovalService:
-    background_model = getattr(app_config, "BACKGROUND_REMOVAL_MODEL", "u2net")
-    alpha_matting = getattr(app_config, "BACKGROUND_REMOVAL_ALPHA_MATTING", True)
-    post_process = getattr(app_config, "BACKGROUND_REMOVAL_POST_PROCESS", True)
-    if fast_mode:
-        background_model = getattr(
-            app_config, "BACKGROUND_REMOVAL_MODEL_FAST", "birefnet-general-lite"
-        )
-        alpha_matting = getattr(app_config, "BACKGROUND_REMOVAL_FAST_ALPHA_MATTING", False)
-        post_process = getattr(app_config, "BACKGROUND_REMOVAL_FAST_POST_PROCESS", False)
-    return BackgroundRemovalService(
-        RESULT_DIR,
-        model_name=background_model,
-        alpha_matting=alpha_matting,
-        alpha_matting_foreground_threshold=getattr(
-            app_config, "BACKGROUND_REMOVAL_FG_THRESHOLD", 240
-        ),
-        alpha_matting_background_threshold=getattr(
-            app_config, "BACKGROUND_REMOVAL_BG_THRESHOLD", 10
-        ),
-        alpha_matting_erode_size=getattr(app_config, "BACKGROUND_REMOVAL_ERODE_SIZE", 10),
-        post_process_mask=post_process,
-        lazy_init=bool(getattr(app_config, "BACKGROUND_REMOVAL_LAZY_INIT", False)),
-    )
+def _resolve_ai_metadata(config: Mapping[str, object]) -> tuple[str, str]:
+    provider = str(config.get("IMAGE_PROVIDER", "nano_banana"))
+    model_name = str(config.get("GEMINI_MODEL", "gemini-3-pro-image-preview"))
+    if _coerce_bool(config.get("FAST_MODE", False)):
+        model_name = str(config.get("GEMINI_MODEL_FAST", "gemini-2.5-flash-image"))
+    return describe_editor(provider, model_name)
 
 
 def _build_services() -> AppServices:
+    global _db_pool
     app_config = _get_config_class()
     ensure_directories()
 
@@ -104,29 +90,39 @@ def _build_services() -> AppServices:
     if not db_url:
         raise RuntimeError("DATABASE_URL is required for image storage.")
 
-    image_store = ImageAssetStore(db_url, getattr(app_config, "ALLOWED_EXTENSIONS", []))
-    history_store = GenerationHistoryStore(db_url)
+    db_pool = create_pool(
+        db_url,
+        min_size=getattr(app_config, "DB_POOL_MIN_SIZE", 2),
+        max_size=getattr(app_config, "DB_POOL_MAX_SIZE", 20),
+    )
+    _db_pool = db_pool
+    image_store = ImageAssetStore(db_pool, getattr(app_config, "ALLOWED_EXTENSIONS", []))
+    history_store = GenerationHistoryStore(db_pool)
     if _auto_migrate_enabled(app_config):
         image_store.ensure_schema()
         history_store.ensure_schema()
 
-    config_values = {key: getattr(app_config, key) for key in dir(app_config) if key.isupper()}
+    config_values = config_snapshot(app_config)
     ai_label, ai_suffix = _resolve_ai_metadata(config_values)
     editor = build_image_editor(config_values)
     pipeline = ImagePipeline(
-        result_dir=RESULT_DIR,
         editor=editor,
         ai_label=ai_label,
         ai_suffix=ai_suffix,
+        png_compress_level=int(getattr(app_config, "PIPELINE_PNG_COMPRESS_LEVEL", 1)),
     )
     fast_mode = bool(getattr(app_config, "FAST_MODE", False))
-    background_removal = _build_background_removal(app_config, fast_mode)
-    styles = PostgresStyleCatalog(db_url, getattr(app_config, "STYLE_RULES_MAX_CHARS", 4000))
+    background_removal = build_background_removal(config_values, RESULT_DIR, fast_mode)
+    background_removal_alt = build_background_removal(
+        config_values, RESULT_DIR, not fast_mode, lazy_init=True
+    )
+    styles = PostgresStyleCatalog(db_pool, getattr(app_config, "STYLE_RULES_MAX_CHARS", 4000))
 
     return AppServices(
         assets=image_store,
         pipeline=pipeline,
         background_removal=background_removal,
+        background_removal_alt=background_removal_alt,
         styles=styles,
         history=history_store,
     )
@@ -135,29 +131,71 @@ def _build_services() -> AppServices:
 def _get_services() -> AppServices:
     global _services
     if _services is None:
-        _services = _build_services()
+        # gevent/threaded workers can race here; only one of them builds the pool and clients.
+        with _services_lock:
+            if _services is None:
+                _services = _build_services()
     return _services
 
 
-def _select_pipeline(
-    app_config: object, base_pipeline: ImagePipeline, fast_mode: bool
-) -> ImagePipeline:
-    default_fast = bool(getattr(app_config, "FAST_MODE", False))
-    if fast_mode == default_fast:
-        return base_pipeline
+@worker_process_init.connect
+def _warm_worker(**_kwargs) -> None:
+    # Each forked child builds its services and both pipeline variants before taking jobs.
+    try:
+        services = _get_services()
+        config_values = config_snapshot(_get_config_class())
+        select_pipeline(
+            config_values, services.pipeline, not bool(config_values.get("FAST_MODE", False))
+        )
+        if _coerce_bool(config_values.get("BACKGROUND_REMOVAL_PRELOAD_ALT", False)):
+            # Keeps the toggled-mode model resident too, at the cost of its RAM per child.
+            services.background_removal_alt.warm()
+    except Exception:
+        logger.exception("Worker warm-up failed; services will be built on first task")
+
+
+@worker_init.connect
+def _warm_shared_process_worker(sender=None, **_kwargs) -> None:
+    # worker_process_init only fires in prefork children; solo, thread, and green pools run
+    # tasks in the main process, so they warm here. Prefork parents must not open the pool.
+    pool_cls = getattr(sender, "pool_cls", None)
+    pool_name = pool_cls if isinstance(pool_cls, str) else getattr(pool_cls, "__module__", "")
+    if not pool_name or "prefork" in pool_name:
+        return
+    _warm_worker()
 
-    config_values = {key: getattr(app_config, key) for key in dir(app_config) if key.isupper()}
-    config_values["FAST_MODE"] = fast_mode
-    editor = build_image_editor(config_values)
-    ai_label, ai_suffix = _resolve_ai_metadata(config_values)
-    return ImagePipeline(result_dir=RESULT_DIR, editor=editor, ai_label=ai_label, ai_suffix=ai_suffix)
 
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def _close_db_pool(**_kwargs) -> None:
+    # Prefork children fire worker_process_shutdown; solo/gevent workers only fire worker_shutdown.
+    global _db_pool
+    if _db_pool is not None:
+        _db_pool.close()
+        _db_pool = None
 
-def _write_temp_image(temp_dir: Path, stem: str, suffix: str, payload: bytes) -> Path:
-    safe_suffix = suffix if suffix.startswith(".") else f".{suffix}"
-    path = temp_dir / f"{stem}{safe_suffix}"
-    path.write_bytes(payload)
-    return path
+
+# Small pool for overlapping independent DB reads within a task.
+_IO_WORKERS = 4
+_io_pool: tuple[int, ThreadPoolExecutor] | None = None
+
+
+def _io_executor() -> ThreadPoolExecutor:
+    """Returns this process's I/O executor; under gevent its threads are greenlets."""
+    global _io_pool
+    pid = os.getpid()
+    if _io_pool is None or _io_pool[0] != pid:
+        _io_pool = (pid, ThreadPoolExecutor(max_workers=_IO_WORKERS, thread_name_prefix="ivg-io"))
+    return _io_pool[1]
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def _shutdown_io_executor(**_kwargs) -> None:
+    global _io_pool
+    if _io_pool is not None and _io_pool[0] == os.getpid():
+        _io_pool[1].shutdown(wait=False, cancel_futures=True)
+        _io_pool = None
 
 
 @celery_app.task(bind=True, name="ivg.generate_variation", queue=DEFAULT_QUEUE)
@@ -175,75 +213,81 @@ def generate_variation_task(
         return {"job_type": "variation", "error": "Missing session id."}
 
     services = _get_services()
-    app_config = _get_config_class()
     pipeline = services.pipeline
     if fast_mode is not None:
-        pipeline = _select_pipeline(app_config, pipeline, bool(fast_mode))
+        pipeline = select_pipeline(
+            config_snapshot(_get_config_class()), pipeline, bool(fast_mode)
+        )
 
-    style = services.styles.get_style(style_id) if style_id else None
-    if style_id and not style:
-        return {"job_type": "variation", "error": "Style not found."}
+    prompt = (prompt or "").strip()
+    source_asset_id = upload_asset_id or (previous_result if use_previous else "")
+    style_future = None
+    if style_id:
+        # The reference image is needed for the AI edit or when the style is the source.
+        # The style and source asset reads are independent, so they overlap.
+        style_future = _io_executor().submit(
+            services.styles.get_style_bundle,
+            style_id,
+            include_reference=bool(prompt) or not source_asset_id,
+        )
 
     uid = uuid4().hex
-    source_path: Path | None = None
+    source: Path | bytes | None = None
     original_url: str | None = None
 
     try:
-        with TemporaryDirectory() as temp_dir:
-            temp_path = Path(temp_dir)
-            # Resolve the source image from upload, previous result, or style reference.
-            if upload_asset_id:
-                asset = services.assets.get_asset(session_id, upload_asset_id)
-                if not asset:
+        asset = services.assets.get_asset(session_id, source_asset_id) if source_asset_id else None
+        style_bundle = style_future.result() if style_future is not None else None
+        if style_id and not style_bundle:
+            return {"job_type": "variation", "error": "Style not found."}
+        style = style_bundle.style if style_bundle else None
+
+        # Resolve the source image from upload, previous result, or style reference.
+        # Stored assets are handed to the pipeline as bytes rather than via a temp file.
+        if source_asset_id:
+            if not asset:
+                if upload_asset_id:
                     return {"job_type": "variation", "error": "Uploaded image not found."}
-                suffix = extension_for_mime(asset.content_type)
-                source_path = _write_temp_image(temp_path, uid, suffix, asset.image_bytes)
-                original_url = f"/api/images/{asset.asset_id}"
-            elif use_previous and previous_result:
-                asset = services.assets.get_asset(session_id, previous_result)
-                if not asset:
-                    return {"job_type": "variation", "error": "Previous result not found."}
-                suffix = extension_for_mime(asset.content_type)
-                source_path = _write_temp_image(temp_path, uid, suffix, asset.image_bytes)
-                original_url = f"/api/images/{asset.asset_id}"
-            elif style:
-                source_path = services.styles.materialize_reference(style, RESULT_DIR)
-                if not source_path.is_file():
-                    return {"job_type": "variation", "error": "Style reference unavailable."}
-                original_url = f"/api/styles/{style.style_id}/reference"
-            else:
-                return {
-                    "job_type": "variation",
-                    "error": "Upload an image, enable forward generation, or select a style.",
-                }
-
-            style_rules = services.styles.load_rules(style) if style else None
-            style_reference_bytes = style.reference_bytes if style else None
-            result = pipeline.process(
-                source_path,
-                (prompt or "").strip(),
-                uid,
-                style_rules,
-                style_reference_bytes=style_reference_bytes,
-                result_dir=temp_path,
-            )
-            result_bytes = result.result_path.read_bytes()
-            result_id = services.assets.save_bytes(
-                session_id,
-                result_bytes,
-                "image/png",
-                filename=f"{uid}.png",
-                role="result",
-            )
+                return {"job_type": "variation", "error": "Previous result not found."}
+            source = asset.image_bytes
+            original_url = f"/api/images/{asset.asset_id}"
+        elif style:
+            source = services.styles.materialize_reference(style, RESULT_DIR)
+            if not source.is_file():
+                return {"job_type": "variation", "error": "Style reference unavailable."}
+            original_url = f"/api/styles/{style.style_id}/reference"
+        else:
+            return {
+                "job_type": "variation",
+                "error": "Upload an image, enable forward generation, or select a style.",
+            }
+
+        style_rules = style_bundle.rules if style_bundle else None
+        # The reference image only feeds the AI edit, so it is not passed without a prompt.
+        style_reference_bytes = style_bundle.reference_bytes if style_bundle and prompt else None
+        process_args = (source, prompt, uid, style_rules)
+        process_kwargs = {"style_reference_bytes": style_reference_bytes}
+        if prompt:
+            # Mostly waiting on the provider; the editor moves its image decoding and
+            # encoding to native threads, and patched sockets yield to other greenlets.
+            result = pipeline.process(*process_args, **process_kwargs)
+        else:
+            # The no-prompt path is pure PIL decode/encode, which would stall the hub.
+            result = run_cpu_bound(pipeline.process, *process_args, **process_kwargs)
+        # The asset and its history entry commit together in one transaction.
+        result_id = services.assets.save_bytes_with_history(
+            services.history,
+            session_id,
+            result.result_bytes,
+            "image/png",
+            original_url,
+            filename=f"{uid}.png",
+            role="result",
+        )
     except Exception:
         logger.exception("Variation task failed")
         raise
 
-    try:
-        services.history.add_entry(session_id, result_id, original_url)
-    except Exception as exc:
-        logger.warning("Failed to record history: %s", exc)
-
     return {
         "job_type": "variation",
         "result_id": result_id,
@@ -254,7 +298,14 @@ def generate_variation_task(
     }
 
 
-@celery_app.task(bind=True, name="ivg.remove_background", queue=BG_QUEUE)
+# Long CPU-bound jobs are acked on completion so a killed child's job is redelivered.
+@celery_app.task(
+    bind=True,
+    name="ivg.remove_background",
+    queue=BG_QUEUE,
+    acks_late=True,
+    reject_on_worker_lost=True,
+)
 def remove_background_task(
     self,
     session_id: str,
@@ -270,8 +321,8 @@ def remove_background_task(
     app_config = _get_config_class()
     removal_service = services.background_removal
     if fast_mode != bool(getattr(app_config, "FAST_MODE", False)):
-        # Build a fast-mode background remover when toggled per request.
-        removal_service = _build_background_removal(app_config, fast_mode)
+        # The toggled-mode remover is shared across tasks once its model is loaded.
+        removal_service = services.background_removal_alt
 
     if not removal_service.available:
         return {"job_type": "background_removal", "error": "Background removal unavailable."}
@@ -280,22 +331,22 @@ def remove_background_task(
     if not asset:
         return {"job_type": "background_removal", "error": "Result image not found."}
 
+    # get_asset reads the BYTEA in binary format straight into one bytes object, and rembg
+    # wraps bytes in BytesIO without copying; a memoryview would be rejected by rembg.remove.
     output_bytes = removal_service.remove_background_bytes(asset.image_bytes)
     if not output_bytes:
         return {"job_type": "background_removal", "error": "Background removal failed."}
 
-    output_id = services.assets.save_bytes(
+    original_url = f"/api/images/{asset.asset_id}"
+    output_id = services.assets.save_bytes_with_history(
+        services.history,
         session_id,
         output_bytes,
         "image/png",
+        original_url,
         filename=None,
         role="bg_removed",
     )
-    original_url = f"/api/images/{asset.asset_id}"
-    try:
-        services.history.add_entry(session_id, output_id, original_url)
-    except Exception as exc:
-        logger.warning("Failed to record background removal history: %s", exc)
 
     return {
         "job_type": "background_removal",